@@ -4,8 +4,8 @@
 # GNU Lesser General Public License version 2.1
 
 import errno
-import hashlib
 import os
+import random
 import re
 import stat
 import string
@@ -13,14 +13,20 @@ import struct
 import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from persistent.TimeStamp import TimeStamp
 from ZODB import POSException
 from ZODB.BaseStorage import BaseStorage
 
+from . import checksums
+from .ObjectCache import ObjectCache
+from .Prefetcher import Prefetcher
+from .SerialIndex import SerialIndex
 from .utils import (OMAGIC, TMAGIC, ConfigParserError, DirectoryStorageError,
                     DirectoryStorageVersionError, FileDoesNotExist, logger,
                     loglevel_BLATHER, oid2str, timestamp2tid, z64, z128)
+from .Verifier import Verifier
 
 _some_unique_object = []
 
@@ -53,6 +59,11 @@ class BaseDirectoryStorage(BaseStorage):
         self._oid = self.filesystem.read_database_file("x.oid")
         if len(self._oid) != 8:
             raise DirectoryStorageError("Bad stored oid")
+        # Every oid stored in a committed transaction is no greater than
+        # this. Oids above it which were allocated by new_oid have never
+        # been stored.
+        self._persisted_oid = self._oid
+        self._fresh_oid_skips = 0
         self._prev_serial = self.filesystem.read_database_file("x.serial")
         if len(self._prev_serial) != 8:
             raise DirectoryStorageError("Bad stored serial")
@@ -68,6 +79,33 @@ class BaseDirectoryStorage(BaseStorage):
         for op in ["read", "write", "overwrite", "undolog", "undo", "history", "pack"]:
             v = self.filesystem.config.getint("md5policy", op)
             setattr(self, "_md5_" + op, v)
+        try:
+            checksum = self.filesystem.config.get("checksum", "write")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [checksum]/write=md5")
+            checksum = "md5"
+        self._checksum_tag = checksums.tag_for_name(checksum)
+        self._verifier = None
+        if self._md5_read == 2:
+            # Sampled verification
+            try:
+                self._md5_read_fraction = self.filesystem.config.getfloat(
+                    "md5policy", "read_fraction"
+                )
+            except ConfigParserError:
+                logger.info(
+                    "assuming config/settings should have [md5policy]/read_fraction=0.1"
+                )
+                self._md5_read_fraction = 0.1
+            try:
+                queue_size = self.filesystem.config.getint("md5policy", "verify_queue")
+            except ConfigParserError:
+                logger.info(
+                    "assuming config/settings should have [md5policy]/verify_queue=1000"
+                )
+                queue_size = 1000
+            self._verifier = Verifier(self, queue_size)
         self._times = [time.time()]
         self.history_timeout = self.filesystem.config.getint(
             "storage", "history_timeout"
@@ -130,6 +168,55 @@ class BaseDirectoryStorage(BaseStorage):
                 self.keepclass[key] = keep_extra(max(0, int(v[6:])))
             else:
                 logger.error("bad [keepclass]/%s" % (key,))
+        #
+        try:
+            cache_size = self.filesystem.config.getint("cache", "size")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [cache]/size=0")
+            cache_size = 0
+        self._object_cache = ObjectCache(cache_size)
+        try:
+            index_limit = self.filesystem.config.getint("cache", "serial_index")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info(
+                "assuming config/settings should have [cache]/serial_index=1000000"
+            )
+            index_limit = 1000000
+        self._serial_index = SerialIndex(index_limit)
+        #
+        try:
+            self._load_threads = self.filesystem.config.getint(
+                "storage", "load_threads"
+            )
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [storage]/load_threads=4")
+            self._load_threads = 4
+        # The thread pool used by loadMany is created when first needed
+        self._load_pool = None
+        self._load_pool_lock = threading.Lock()
+        # The transaction finished by this thread, if it is not yet durable
+        self._finished = threading.local()
+        #
+        try:
+            prefetch = self.filesystem.config.getint("prefetch", "enabled")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [prefetch]/enabled=0")
+            prefetch = 0
+        self._prefetcher = None
+        if prefetch:
+            if not cache_size:
+                # Nowhere to put prefetched files
+                logger.error("[prefetch]/enabled needs a non-zero [cache]/size")
+            else:
+                self._prefetcher = Prefetcher(
+                    self,
+                    self.filesystem.config.getint("prefetch", "queue_size"),
+                    self.filesystem.config.getint("prefetch", "depth"),
+                )
 
     def get_current_transaction(self):
         try:
@@ -156,17 +243,115 @@ class BaseDirectoryStorage(BaseStorage):
             logger.error("Duplicate call to close")
         else:
             logger.info("Closing")
+            if self._object_cache.budget:
+                logger.log(
+                    self.filesystem.ENGINE_NOISE,
+                    "Object cache: %(hits)d hits, %(misses)d misses, "
+                    "%(evictions)d evictions, %(prefetch_used)d prefetches used"
+                    % self._object_cache.report(),
+                )
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+                self._prefetcher = None
+            if self._verifier is not None:
+                report = self._verifier.report()
+                logger.log(
+                    self.filesystem.ENGINE_NOISE,
+                    "Background verification: %(verified)d verified, "
+                    "%(dropped)d dropped, %(failures)d failures" % report,
+                )
+                self._verifier.close()
+                self._verifier = None
+            if self._load_pool is not None:
+                self._load_pool.shutdown()
+                self._load_pool = None
             self.filesystem.close()
             self.filesystem = None
 
-    def load(self, oid, version):
-        stroid = oid2str(oid)
-        data, serial2 = self._load_object_file(oid)
-        self._check_object_file(oid, serial2, data, self._md5_read)
-        pickle = data[72:]
-        serial = data[64:72]
+    def load(self, oid, version=""):
+        data = self._load_checked(oid, prefetch=1)
+        # The file may be a view of a mapped file. ZODB needs bytes, so
+        # the pickle is still copied out of it. Mapping only saves reading
+        # the whole file into memory before that copy is made.
+        pickle = bytes(data[72:])
+        serial = bytes(data[64:72])
         return pickle, serial
 
+    def _load_checked(self, oid, serial=None, prefetch=0):
+        # Load an object file on behalf of load, loadSerial or loadBefore,
+        # and check it according to the [md5policy]/read setting. Files which
+        # pass are kept in the object cache, so a cache hit skips both the
+        # read and the check.
+        serial = self._resolve_serial(oid, serial)
+        key = oid, serial
+        data, fresh = self._object_cache.lookup(key)
+        if data is None:
+            generation = self._object_cache.generation()
+            data, serial2 = self._load_object_file(oid, serial)
+            self._check_loaded_file(oid, serial2, data)
+            self._object_cache.put(key, data, generation)
+            fresh = 1
+        if prefetch and fresh and self._prefetcher is not None:
+            # This file has just been read, or was read ahead and is used
+            # for the first time. Read ahead the objects it references.
+            self._prefetcher.loaded(data)
+        return data
+
+    def _prefetch_object_file(self, oid):
+        # Called in the prefetcher thread to read the current revision
+        # of an object into the cache. Returns the file, or None if it
+        # was already cached.
+        serial = self._resolve_serial(oid, None)
+        key = oid, serial
+        if key in self._object_cache:
+            return None
+        generation = self._object_cache.generation()
+        data, serial2 = self._load_object_file(oid, serial)
+        self._check_loaded_file(oid, serial2, data)
+        self._object_cache.put(key, data, generation, prefetched=1)
+        return data
+
+    def _check_loaded_file(self, oid, serial, data):
+        # Check a freshly loaded object file according to [md5policy]/read.
+        # close may forget the verifier while we are loading
+        verifier = self._verifier
+        if verifier is None:
+            self._check_object_file(oid, serial, data, self._md5_read)
+        elif random.random() < self._md5_read_fraction:
+            self._check_object_file(oid, serial, data, 1)
+        else:
+            # Everything but the checksum is cheap to check now
+            self._check_object_file(oid, serial, data, 0)
+            verifier.verify(oid, serial, data)
+
+    def loadMany(self, oids):
+        # Load several objects at once, returning a list of (pickle, serial)
+        # pairs in the same order as oids. Most of the time in a load is
+        # spent waiting for the disk, so the pointer lookups and file reads
+        # are spread across a pool of threads. If any object can not be
+        # loaded then this raises the same exception as load would for the
+        # first one that failed.
+        oids = list(oids)
+        pool = self._get_load_pool()
+        if pool is None or len(oids) < 2:
+            datas = [self._load_checked(oid) for oid in oids]
+        else:
+            datas = list(pool.map(self._load_checked, oids))
+        return [(bytes(data[72:]), bytes(data[64:72])) for data in datas]
+
+    def _get_load_pool(self):
+        if self._load_threads < 2:
+            return None
+        self._load_pool_lock.acquire()
+        try:
+            if self._load_pool is None:
+                self._load_pool = ThreadPoolExecutor(
+                    self._load_threads, thread_name_prefix="DirectoryStorage load"
+                )
+            return self._load_pool
+        finally:
+            self._load_pool_lock.release()
+
     def loadBefore(self, oid, tid):
         raise NotImplementedError()
 
@@ -178,7 +363,7 @@ class BaseDirectoryStorage(BaseStorage):
     def _check_object_file(self, oid, serial, data, check_md5):
         # Given the body of an object file, check as much as we can. Its
         # redundant oid, its redundant serial number (if known), its
-        # redundant length, and md5 checksum of the whole file
+        # redundant length, and checksum of the whole file
         if OMAGIC != data[:4]:
             raise DirectoryStorageError("Bad magic number in oid %r" % (oid2str(oid),))
         l = struct.unpack("!I", data[4:8])[0]
@@ -194,7 +379,8 @@ class BaseDirectoryStorage(BaseStorage):
         md5sum = data[40:56]
         serials_plus_pickle = data[56:]
         if md5sum != z128 and check_md5:
-            if hashlib.md5(serials_plus_pickle).digest() != md5sum:
+            # byte 24 says which algorithm computed the checksum
+            if checksums.checksum(data[24], serials_plus_pickle) != md5sum:
                 raise DirectoryStorageError(
                     "Pickle checksum error reading oid %r" % (oid2str(oid),)
                 )
@@ -205,15 +391,21 @@ class BaseDirectoryStorage(BaseStorage):
                 % (oid2str(appserial), oid2str(serial), oid2str(oid))
             )
 
-    def _load_object_file(self, oid):
+    def _load_object_file(self, oid, serial=None):
         # returns a tuple of the object file content, and the serial number if known
-        # from a redundant source (such as filename, in a 'full' storage)
+        # from a redundant source (such as filename, in a 'full' storage).
+        # The content may be a view as returned by read_database_file_view.
         raise NotImplementedError("_load")
 
+    def _resolve_serial(self, oid, serial):
+        # Return the serial of the revision that _load_object_file would
+        # load, if that can be known without reading the object file.
+        # This is used as part of the object cache key.
+        return serial
+
     def _get_current_serial(self, oid):
         # return the current serial of this oid
         raise NotImplementedError("_get_current_serial")
-        # could use some caching here?
 
     def _begin(self, tid, u, d, e):
         self.filesystem._pre_transaction()
@@ -238,17 +430,41 @@ class BaseDirectoryStorage(BaseStorage):
             print("%.1f ms per transaction" % (1000 * per_item,), file=sys.stderr)
 
     def _make_file_body(self, oid, serial, old_serial, data, undofrom=z64):
-        header = OMAGIC + struct.pack("!I", len(data) + 72) + oid + undofrom + z128
-        assert len(header) == 40
-        serials_plus_pickle = old_serial + serial + data
+        # Returns the object file as a list of buffers; the 72 byte header,
+        # and the pickle if there is one. The pickle is not copied.
+        serials = old_serial + serial
         # XXXX is it worth allowing the md5 checksum to be delayed
         # until the asynchronous flush too?
         if self._md5_write:
-            md5sum = hashlib.md5(serials_plus_pickle).digest()
+            tag = self._checksum_tag
+            c = checksums.new(tag)
+            c.update(serials)
+            c.update(data)
+            md5sum = c.digest()
         else:
+            tag = 0
             md5sum = z128
-        body = header + md5sum + serials_plus_pickle
-        return body
+        header = (
+            OMAGIC
+            + struct.pack("!I", len(data) + 72)
+            + oid
+            + undofrom
+            + struct.pack("!B15x", tag)
+        )
+        assert len(header) == 40
+        if not data:
+            # George Bailey object
+            return [header + md5sum + serials]
+        return [header + md5sum + serials, data]
+
+    def _get_stored_serial(self, oid):
+        # The current serial for a store in this transaction. Objects
+        # created by new_oid since the last commit have none, which is
+        # known without looking for their pointer file.
+        if self._persisted_oid < oid <= self._oid:
+            self._fresh_oid_skips += 1
+            return None
+        return self._get_current_serial(oid)
 
     def _clear_temp(self):
         self._transaction_directory = None
@@ -258,6 +474,7 @@ class BaseDirectoryStorage(BaseStorage):
         self._vote_impl()
         # write out the database's most recent oid
         td.write("x.oid", self._oid)
+        td.persisted_oid = self._oid
         td.write("x.serial", self.get_current_transaction())
         # write to stable storage in the journal
         td.vote()
@@ -266,9 +483,27 @@ class BaseDirectoryStorage(BaseStorage):
         # record any transaction-specific files
         raise NotImplementedError("_vote_impl")
 
+    def tpc_finish(self, transaction, f=None):
+        self._finished.transaction = None
+        tid = BaseStorage.tpc_finish(self, transaction, f)
+        # Wait for the transaction to become durable, if the filesystem
+        # left that until after the commit lock was released.
+        td = self._finished.transaction
+        if td is not None:
+            self._finished.transaction = None
+            td.wait_until_durable()
+        return tid
+
     def _finish(self, tid, user, desc, ext):
+        td = self._transaction_directory
         self._prev_serial = self.get_current_transaction()
-        self._transaction_directory.finish()
+        td.finish()
+        # Oids stored by a client that did not get them from new_oid may be
+        # greater than x.oid
+        persisted = max([td.persisted_oid] + list(td.oids.keys()))
+        if persisted > self._persisted_oid:
+            self._persisted_oid = persisted
+        self._finished.transaction = td
 
     def _abort(self):
         self._transaction_directory.abort()
@@ -278,6 +513,11 @@ class BaseDirectoryStorage(BaseStorage):
             "enter_snapshot": None,
             "leave_snapshot": None,
             "get_snapshot_code": None,
+            "clone_snapshot": None,
+            "remove_snapshot_clone": None,
+            "get_cache_stats": None,
+            "stats": None,
+            "loadMany": None,
             "is_directory_storage": None,
         }
 
@@ -313,9 +553,34 @@ class BaseDirectoryStorage(BaseStorage):
         # leave snapshot mode
         return self.filesystem.leave_snapshot("user/" + code)
 
+    def clone_snapshot(self, code):
+        # A user process wants a copy of the database, for backup perhaps,
+        # without keeping the storage in snapshot mode while it reads it.
+        # Returns the path of the copy relative to the storage directory.
+        # The user process should remove it once finished.
+        return self.filesystem.clone_snapshot(code)
+
+    def remove_snapshot_clone(self, code):
+        self.filesystem.remove_snapshot_clone(code)
+
     def get_snapshot_code(self):
         return self.filesystem.snapshot_code
 
+    def get_cache_stats(self):
+        stats = self._object_cache.report()
+        stats["serial_index_entries"] = len(self._serial_index)
+        stats["serial_index_bytes"] = self._serial_index.nbytes()
+        stats["fresh_oid_skips"] = self._fresh_oid_skips
+        if self._prefetcher is not None:
+            for k, v in self._prefetcher.report().items():
+                stats["prefetch_" + k] = v
+        return stats
+
+    def stats(self):
+        # How far the journal flusher is behind, and what it has done.
+        # Useful when tuning the [journal] settings.
+        return self.filesystem.stats()
+
     _do_packing_in_new_thread = 1  # changed by unit tests only
 
     def pack(self, t, referencesf):
@@ -394,16 +659,24 @@ class BaseDirectoryStorage(BaseStorage):
             # This is a hack... we need to store the new database pack time into
             # the database directory. The right way to do that is in a transaction,
             # but that is complicated. For now just inject it directly into the
-            # directory.
-            self.filesystem.write_file(
-                "A/" + self.filesystem.filename_munge("x.packed"), t
+            # directory. It is replaced rather than rewritten in place,
+            # because a snapshot clone may share the file.
+            self.filesystem.write_file("misc/.packed", t)
+            self.filesystem.overwrite(
+                "misc/.packed", "A/" + self.filesystem.filename_munge("x.packed")
             )
         else:
             # This pack time is earlier than a previous pack. Some storages
             # consider this an error. we dont.
             pass
         # do the packing
-        return self._pack(t, referencesf)
+        try:
+            return self._pack(t, referencesf)
+        finally:
+            # Packing may have removed revisions that are in the object cache,
+            # and the pointer files of unreachable objects
+            self._object_cache.clear()
+            self._serial_index.clear()
 
     def _pack(self, t, referencesf):
         raise NotImplementedError("_pack")
@@ -51,7 +51,8 @@ class FilesystemPrimitives:
         # Write those bytes to the specified file. If an old file
         # exists in the same name, it is overwritten. Data is written to
         # stable storage, but sync_directory must be called on its
-        # parent if this was a new file
+        # parent if this was a new file. content may also be a list of
+        # buffers, which are written one after another.
         raise NotImplementedError("write_file")
 
     def read_file(self, filename):
@@ -59,6 +60,25 @@ class FilesystemPrimitives:
         # raises FileDoesNotExist if necessary
         raise NotImplementedError("read_file")
 
+    def read_file_view(self, filename):
+        # As read_file, but the content may be returned in any object
+        # supporting len, slicing, and the buffer interface.
+        return self.read_file(filename)
+
+    def read_file_range(self, filename, offset, length):
+        # Return length bytes from the specified offset in the file.
+        # raises FileDoesNotExist if necessary
+        return self.read_file(filename)[offset : offset + length]
+
+    def sync_file(self, filename):
+        # Write the specified file to stable storage
+        raise NotImplementedError("sync_file")
+
+    def file_size(self, filename):
+        # Return the length of the specified file, without reading it.
+        # raises FileDoesNotExist if necessary
+        return len(self.read_file(filename))
+
     def modify_file(self, filename, offset, content):
         # Write those bytes at the specified offset to the specified file.
         # Data is not immediately written to stable storage
@@ -88,6 +108,21 @@ class FilesystemPrimitives:
         # Remove directory a.
         raise NotImplementedError("rmdir")
 
+    def clone_file(self, a, b):
+        # Make file b a copy of file a, sharing its storage if possible.
+        # File b must not previously exist. The copy may be a hard link,
+        # so a must not be modified in place afterwards.
+        raise NotImplementedError("clone_file")
+
+    def modification_time(self, a):
+        # Return the time file or directory a was last modified
+        raise NotImplementedError("modification_time")
+
+    def forget_directory(self, a):
+        # Called after directory a was removed from the database
+        # directories, in case we remember that it exists.
+        pass
+
     def mark_context(self, base):
         # Create a new mark context. All files are initially unmarked
         raise NotImplementedError("mark_context")
@@ -146,6 +181,22 @@ class BaseFilesystem(FilesystemPrimitives):
         # called when the storage is closed
         raise NotImplementedError("close")
 
+    def stats(self):
+        # Return a dictionary of statistics about the journal
+        return {}
+
+    def wait_until_flushed(self, timeout=None):
+        # Move every transaction committed so far out of the journal, and
+        # wait until that is done. Returns false if timeout seconds pass
+        # first.
+        raise NotImplementedError("wait_until_flushed")
+
+    def wait_until_recombined(self, timeout=None):
+        # Wait until out of snapshot mode, with every file written during
+        # it moved into the A directory. Returns false if timeout seconds
+        # pass first.
+        raise NotImplementedError("wait_until_recombined")
+
     def transaction(self, tid):
         # must return a BaseFilesystemTransaction instance
         raise NotImplementedError("transaction")
@@ -168,13 +219,30 @@ class BaseFilesystem(FilesystemPrimitives):
         # in a string
         raise NotImplementedError("read_database_file")
 
+    def read_database_file_view(self, name):
+        # As read_database_file, but the content may be returned in any
+        # object supporting len, slicing, and the buffer interface, such as
+        # a memoryview over a mapped file. Use bytes() on any slice that is
+        # kept or compared.
+        return self.read_database_file(name)
+
+    def database_file_size(self, name):
+        # return the length of that named record
+        return len(self.read_database_file(name))
+
+    def patch_file(self, filename, offset, content):
+        # As modify_file, for a file in the A directory which may be
+        # shared with a snapshot clone
+        self.modify_file(filename, offset, content)
+
 
 class BaseFilesystemTransaction:
     # BaseStorage maintains a commit lock that ensures that only one instance
     # will be in use at one time.
 
     def write(self, name, data):
-        # write a named record into the database
+        # write a named record into the database. data is bytes, or a
+        # list of buffers which are written one after another
         raise NotImplementedError("write")
 
     def vote(self):
@@ -185,5 +253,16 @@ class BaseFilesystemTransaction:
         # finalize transaction
         raise NotImplementedError("finish")
 
+    def wait_until_durable(self):
+        # Called after finish, once the storage has released its commit
+        # lock. Does not return until the transaction is durable, if
+        # finish left that to be done later.
+        pass
+
+    def awaiting_sync(self):
+        # Called after finish. True if the transaction is not durable yet.
+        # Reading its files then waits until it is.
+        return 0
+
     def abort(self):
         raise NotImplementedError("abort")
@@ -50,6 +50,12 @@ class DirectoryStorageToolkit(SimpleItem):
         """ """
         return self._p_jar._storage.get_snapshot_code()
 
+    security.declareProtected(MANAGE_DS, "journalStats")
+
+    def journalStats(self):
+        """Statistics about the journal flusher"""
+        return self._p_jar._storage.stats()
+
     security.declareProtected(MANAGE_DS, "isDirectorystorage")
 
     def isDirectorystorage(self):
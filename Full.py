@@ -4,7 +4,6 @@
 # GNU Lesser General Public License version 2.1
 
 import errno
-import hashlib
 import os
 import pickle
 import pickle as cPickle
@@ -17,6 +16,7 @@ import time
 from ZODB import POSException, TimeStamp
 from ZODB.ConflictResolution import ConflictResolvingStorage
 
+from . import checksums
 from .BaseDirectoryStorage import BaseDirectoryStorage
 from .utils import (CMAGIC, OMAGIC, TMAGIC, DanglingReferenceError,
                     DirectoryStorageError, DirectoryStorageVersionError,
@@ -27,16 +27,9 @@ from .utils import (CMAGIC, OMAGIC, TMAGIC, DanglingReferenceError,
 
 class Full(BaseDirectoryStorage, ConflictResolvingStorage):
     def _load_object_file(self, oid, serial=None):
-        if serial is None:
-            serial = self._get_current_serial(oid)
-        if serial is None:
-            raise POSException.POSKeyError(oid)
-        if len(serial) != 8:
-            stroid = oid2str(oid)
-            raise DirectoryStorageError("Bad current revision for oid %r" % (stroid,))
-
+        serial = self._resolve_serial(oid, serial)
         try:
-            data = self.filesystem.read_database_file(
+            data = self.filesystem.read_database_file_view(
                 "o" + oid2str(oid) + "." + oid2str(serial)
             )
         except FileDoesNotExist:
@@ -47,20 +40,55 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
 
         return data, serial
 
+    def _object_is_missing(self, oid):
+        # Like trying to load the current revision, but only reads the
+        # pointer file, if the serial index does not already know it,
+        # and the size of the revision file.
+        serial = self._get_current_serial(oid)
+        if serial is None:
+            return 1
+        name = "o" + oid2str(oid) + "." + oid2str(serial)
+        try:
+            size = self.filesystem.database_file_size(name)
+        except FileDoesNotExist:
+            return 1
+        # A zero length pickle means the object's creation was undone.
+        # Loading such a revision raises POSGeorgeBaileyKeyError, which is a
+        # POSKeyError, so a reference to it has always counted as dangling.
+        return size == 72
+
+    def _resolve_serial(self, oid, serial):
+        if serial is None:
+            serial = self._get_current_serial(oid)
+        if serial is None:
+            raise POSException.POSKeyError(oid)
+        if len(serial) != 8:
+            stroid = oid2str(oid)
+            raise DirectoryStorageError("Bad current revision for oid %r" % (stroid,))
+        return serial
+
     def registerDB(self, db):
         self.db = db
         self._db_transform = db.transform_record_data
         self._db_untransform = db.untransform_record_data
 
     def _get_current_serial(self, oid):
-        # could use some caching here?
+        # The serial index holds the current serial of recently used
+        # and recently written objects, so most calls never need to
+        # read the pointer file.
+        serial = self._serial_index.get(oid)
+        if serial is not None:
+            return serial
+        generation = self._serial_index.generation()
         stroid = oid2str(oid)
         try:
             data = self.filesystem.read_database_file("o" + stroid + ".c")
         except FileDoesNotExist:
             return None
 
-        return _fix_serial(data, oid)
+        serial = _fix_serial(data, oid)
+        self._serial_index.fill(oid, serial, generation)
+        return serial
 
     def _begin(self, tid, u, d, e):
         # We override this to add our own attributes to the transaction object
@@ -68,22 +96,38 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
         td = self._transaction_directory
         td.oids = {}
         td.refoids = {}
+        td.serials = {}
+
+    def _finish(self, tid, user, desc, ext):
+        td = self._transaction_directory
+        BaseDirectoryStorage._finish(self, tid, user, desc, ext)
+        # The pointer files written in this transaction are now visible
+        # to readers, so the serial index can follow them. With group
+        # commit, reading them waits until the transaction is durable.
+        # The index must not reveal these serials any sooner, so it
+        # forgets them, and readers fill them back in.
+        if td.awaiting_sync():
+            for oid in td.serials.keys():
+                self._serial_index.discard(oid)
+        else:
+            for oid, serial in td.serials.items():
+                self._serial_index.set(oid, serial)
 
     def loadBefore(self, oid, tid):
-        data, serial2 = self._load_object_file(oid)
+        data = self._load_checked(oid)
+        serial2 = bytes(data[64:72])
 
         following = None
 
         while serial2 >= tid:
             following = serial2
             serials_plus_pickle = data[56:]
-            previous_serial = serials_plus_pickle[:8]
-            data, serial2 = self._load_object_file(oid, serial=previous_serial)
+            previous_serial = bytes(serials_plus_pickle[:8])
+            data = self._load_checked(oid, previous_serial)
+            serial2 = bytes(data[64:72])
 
-        self._check_object_file(oid, serial2, data, self._md5_read)
-        pickle = data[72:]
-        serial = data[64:72]
-        return pickle, serial, following
+        pickle = bytes(data[72:])
+        return pickle, serial2, following
 
     def store(self, oid, serial, data, version, transaction):
         if self._is_read_only:
@@ -95,7 +139,7 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
         if version:
             raise DirectoryStorageVersionError("Versions are not supported")
         conflictresolved = 0
-        old_serial = self._get_current_serial(oid)
+        old_serial = self._get_stored_serial(oid)
         if old_serial is None:
             # no previous revision of this object
             old_serial = z64
@@ -160,7 +204,7 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
             # no previous revision of this object
             old_serial = z64
         if data is None:
-            data = ""
+            data = b""
         if oid > self._oid:
             self._oid = oid
         body = self._make_file_body(oid, serial, old_serial, data)
@@ -176,8 +220,9 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
                 td.refoids[refoid] = oid
         # td.oids is our primary index of objects modified in this transaction.
         # values in this mapping indicate whether the modified object is George Bailey
-        is_george_bailey_revision = len(body) == 72
+        is_george_bailey_revision = len(body) == 1  # just the header
         td.oids[oid] = is_george_bailey_revision
+        td.serials[oid] = newserial
         stroid = oid2str(oid)
         if body:
             td.write("o" + stroid + "." + oid2str(newserial), body)
@@ -200,7 +245,7 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
         #    for removal. It is not dangling now, but it would be
         #    once the pack is complete
 
-        good_old_oids = {}
+        to_check = {}
         for refoid, soid in list(td.refoids.items()):
             if refoid in td.oids:
                 if td.oids[refoid]:
@@ -211,19 +256,20 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
                     # A reference to an ordinary object written in this
                     # transaction
                     pass
-            elif refoid in good_old_oids:
-                # We have already checked that it exists in the database
-                pass
             else:
-                # An object outside of this transaction. Try to load it.
-                try:
-                    self._load_object_file(refoid)
-                except POSException.POSKeyError:
-                    # Failed to load the object.
-                    raise DanglingReferenceError(soid, refoid)
-                else:
-                    # This object already exists in the database.
-                    good_old_oids[refoid] = 1
+                # An object outside of this transaction. Check that it
+                # exists in the database.
+                to_check[refoid] = soid
+        refoids = list(to_check.keys())
+        refoids.sort()
+        pool = self._get_load_pool()
+        if pool is None or len(refoids) < 2:
+            missing = [self._object_is_missing(refoid) for refoid in refoids]
+        else:
+            missing = list(pool.map(self._object_is_missing, refoids))
+        for refoid, is_missing in zip(refoids, missing):
+            if is_missing:
+                raise DanglingReferenceError(to_check[refoid], refoid)
 
         # Record the oid of every modified object in the transaction file
         ob = b"".join(list(td.oids.keys()))
@@ -234,15 +280,17 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
             struct.pack("!HHHIH", len(u), len(d), len(e), len(ob), 0) + u + d + e + ob
         )
         if self._md5_write:
-            md5sum = hashlib.md5(body).digest()
+            tag = self._checksum_tag
+            md5sum = checksums.checksum(tag, body)
         else:
+            tag = 0
             md5sum = z128
 
         header = (
             TMAGIC
             + struct.pack("!I", len(body) + 48)
             + td.tid
-            + z64
+            + struct.pack("!B7x", tag)
             + self._prev_serial
         )
         # The transaction file name has a dot in the middle of it as a clue to
@@ -372,7 +420,8 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
         md5sum = data[32:48]
         vdata = data[48:]
         if md5sum != z128 and check_md5:
-            if hashlib.md5(vdata).digest() != md5sum:
+            # byte 16 says which algorithm computed the checksum
+            if checksums.checksum(data[16], vdata) != md5sum:
                 raise DirectoryStorageError(
                     "Pickle checksum error reading oid %r" % (stroid,)
                 )
@@ -433,7 +482,7 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
             if prevtid == z64:
                 # The object was created in this transaction.
                 body = self._make_file_body(
-                    oid, this_transaction, current, "", undofrom=prevtid
+                    oid, this_transaction, current, b"", undofrom=prevtid
                 )
                 self._write_object_file(oid, this_transaction, body)
             else:
@@ -457,14 +506,8 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
         )
 
     def loadSerial(self, oid, serial):
-        try:
-            data = self.filesystem.read_database_file(
-                "o" + oid2str(oid) + "." + oid2str(serial)
-            )
-        except FileDoesNotExist:
-            raise POSException.POSKeyError(oid)
-        self._check_object_file(oid, serial, data, self._md5_read)
-        pickle = data[72:]
+        data = self._load_checked(oid, serial)
+        pickle = bytes(data[72:])
         if not pickle:
             # creation was undone
             raise POSException.POSKeyError(oid)
@@ -805,7 +848,7 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
                 # This transaction is reachable
                 # Ensure it is back-linked from the previous reachable transaction
                 if prev_ptr and prev_ptr != tid:
-                    fs.modify_file(prev_name, 24, tid)
+                    fs.patch_file(prev_name, 24, tid)
                 # Record this... we may have to patch this file if an intermediate
                 # transaction is not reachable.
                 prev_name = name
@@ -860,7 +903,16 @@ class Full(BaseDirectoryStorage, ConflictResolvingStorage):
                             else:
                                 fs.unlink(path)
         if empty:
-            fs.rmdir(directory)
+            # Forget it first, so that a concurrent flush does not trust
+            # that it still exists. One which has already checked retries
+            # if the directory goes before its rename.
+            fs.forget_directory(directory)
+            try:
+                fs.rmdir(directory)
+            except EnvironmentError as e:
+                # A concurrent flush has just moved a file into it
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise
         return total
 
 
@@ -8,15 +8,22 @@ import errno
 import os
 import queue
 import re
+import shutil
+import struct
 import sys
 import tempfile
 import threading
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
 
+from . import checksums
 from .BaseFilesystem import (BaseFilesystem, BaseFilesystemTransaction,
                              FileDoesNotExist)
 from .formats import formats
-from .utils import DirectoryStorageError, RecoveryError, logger, oid2str, z64
+from .utils import (RMAGIC, ConfigParserError, DirectoryStorageError,
+                    RecoveryError, content_crc32, content_length, logger,
+                    oid2str, z64)
 
 
 class LocalFilesystem(BaseFilesystem):
@@ -31,8 +38,14 @@ class LocalFilesystem(BaseFilesystem):
         self._shutdown_flusher = 0
         BaseFilesystem.__init__(self)
         # a dictionary containing the location to look up files, if the
-        # current version is not in the normal location.
-        self.relocations = {}
+        # current version is not in the normal location. Each value is
+        # either the path of a transaction directory in the journal, or
+        # a tuple of the path, offset and length of the file's data in a
+        # transaction record. Readers use it without locking, so it is
+        # never modified in place. Writers hold relocations_lock while they
+        # build a modified RelocationMap, then replace the whole map in one
+        # atomic assignment.
+        self.relocations = RelocationMap()
         self.relocations_lock = threading.Lock()
         # For production, IO overhead is reduced by dealing
         # with journal flushing in big batches. The parametes control
@@ -45,6 +58,16 @@ class LocalFilesystem(BaseFilesystem):
             "journal", "flush_transaction_threshold"
         )
         self.quick_shutdown = self.config.getint("filesystem", "quick_shutdown")
+        try:
+            self.clone_method = self.config.get("filesystem", "clone_method")
+            self.clone_max_age = self.config.getint("filesystem", "clone_max_age")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [filesystem]/clone_method=auto")
+            self.clone_method = "auto"
+            self.clone_max_age = 86400
+        if self.clone_method not in ("auto", "reflink", "link"):
+            raise DirectoryStorageError("Unknown clone_method %r" % (self.clone_method,))
         self.format = self.config.get("structure", "format")
         if self.format not in formats:
             raise DirectoryStorageError("Unknown format %r" % (format,))
@@ -55,9 +78,138 @@ class LocalFilesystem(BaseFilesystem):
         self._flush_lock = threading.RLock()
         self._unflushed = []
         self._async_work_queue = queue.Queue()
+        # Notified by the flusher thread when it finishes a batch, leaves
+        # snapshot mode, or stops. See wait_until_flushed
+        self._flusher_cond = threading.Condition()
+        self._batches_queued = 0
+        self._batches_flushed = 0
+        self._flusher_stopped = 0
         self._backlog_tokens = queue.Queue()
         for i in range(self.config.getint("journal", "backlog")):
             self._backlog_tokens.put(None)
+        try:
+            group_commit = self.config.getint("journal", "group_commit")
+            group_commit_wait = self.config.getfloat("journal", "group_commit_wait")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [journal]/group_commit=0")
+            group_commit = 0
+        if group_commit and self.use_sync:
+            self._journal_syncer = JournalSyncer(self, group_commit_wait)
+        else:
+            self._journal_syncer = None
+        try:
+            self.journal_format = self.config.get("journal", "format")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [journal]/format=directory")
+            self.journal_format = "directory"
+        if self.journal_format not in ("directory", "record"):
+            raise DirectoryStorageError(
+                "Unknown journal format %r" % (self.journal_format,)
+            )
+        try:
+            checksum = self.config.get("checksum", "write")
+        except ConfigParserError:
+            checksum = "md5"
+        self._record_checksum_tag = checksums.tag_for_name(checksum)
+        try:
+            fsync_threads = self.config.getint("journal", "fsync_threads")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [journal]/fsync_threads=1")
+            fsync_threads = 1
+        if fsync_threads > 1 and self.use_sync:
+            self._fsync_pool = ThreadPoolExecutor(
+                fsync_threads, thread_name_prefix="DirectoryStorage fsync"
+            )
+        else:
+            self._fsync_pool = None
+        try:
+            durability = self.config.get("journal", "durability")
+            relaxed_sync_interval = self.config.getfloat(
+                "journal", "relaxed_sync_interval"
+            )
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [journal]/durability=full")
+            durability = "full"
+        if durability not in ("full", "relaxed"):
+            raise DirectoryStorageError("Unknown durability %r" % (durability,))
+        if durability == "relaxed" and self.use_sync:
+            self._relaxed_syncer = RelaxedSyncer(self, relaxed_sync_interval)
+        else:
+            self._relaxed_syncer = None
+        try:
+            self.journal_slots = self.config.getint("journal", "slots")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [journal]/slots=0")
+            self.journal_slots = 0
+        # Empty directories in the journal, named slot_N, which transactions
+        # use in place of creating a new directory. See _claim_slot
+        self._free_slots = []
+        self._next_slot = 0
+        self._slot_lock = threading.Lock()
+        try:
+            self.flush_threads = self.config.getint("journal", "flush_threads")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [journal]/flush_threads=1")
+            self.flush_threads = 1
+        if self.flush_threads > 1:
+            self._flush_pool = ThreadPoolExecutor(
+                self.flush_threads, thread_name_prefix="DirectoryStorage flush"
+            )
+        else:
+            self._flush_pool = None
+        try:
+            max_commit_stall = self.config.getfloat("journal", "max_commit_stall")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [journal]/max_commit_stall=0")
+            max_commit_stall = 0
+        self._flush_controller = FlushController(self, max_commit_stall)
+        try:
+            self.known_directories = self.config.getint(
+                "filesystem", "known_directories"
+            )
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info(
+                "assuming config/settings should have [filesystem]/known_directories=0"
+            )
+            self.known_directories = 0
+        # Directories under A and B which are known to exist, so that
+        # _check_dir need not stat them again. Only directories removed
+        # through forget_directory ever disappear. Used as a set, and
+        # emptied when it grows beyond known_directories entries. Shared
+        # by the flush threads, so guarded by _known_dirs_lock along with
+        # the hit counter.
+        self._known_dirs = {}
+        self._known_dirs_lock = threading.Lock()
+        self.known_dir_hits = 0
+        try:
+            self.journal_path = self.config.get("journal", "path")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [journal]/path=")
+            self.journal_path = ""
+        # Whether the journal is on a different filesystem to the A and B
+        # directories. Set by engage
+        self.journal_separate = 0
+        # Time spent making the files of each transaction durable in the
+        # journal, before it is committed.
+        self.fsync_commits = 0
+        self.fsync_seconds = 0.0
+        self.fsync_max_seconds = 0.0
+        # Work done by the flusher thread, from when each batch is started
+        # until its transactions are removed from the journal
+        self.flushed_batches = 0
+        self.flushed_files = 0
+        self.elided_files = 0
+        self.flush_seconds = 0.0
+        self.flush_max_seconds = 0.0
 
     def engage(self, synchronous=0):
         try:
@@ -73,11 +225,30 @@ class LocalFilesystem(BaseFilesystem):
         else:
             self._unlink_snapshot_file()
             stay_in_snapshot = 0
+        self.journal_separate = self._prepare_journal(self.journal_path)
+        if self.journal_separate:
+            logger.log(
+                self.ENGINE_NOISE,
+                "Journal is on a separate filesystem. Files are copied out of it.",
+            )
         self._flusher = threading.Thread(target=self._flusher)
         self._flusher.setDaemon(1)
         self._flusher.start()
         self._snapshot_lock = threading.Lock()
         self._snapshot_ack = threading.Lock()
+        # Files flushed into B are listed in RECOMBINE_MANIFEST, so that
+        # recombination need not search B for them. A storage last used by
+        # 1.1.21 or earlier may have files in B without a manifest, in
+        # which case we search B once.
+        try:
+            self._recombine_manifest_size = self.file_size(RECOMBINE_MANIFEST)
+        except FileDoesNotExist:
+            self._recombine_manifest_size = 0
+            self._recombine_manifest = not self.listdir("B")
+        else:
+            self._recombine_manifest = 1
+        self._recombine_offset = 0
+        self._recombined_dirs = {}
         # Read the journal, and asynchronously move the files asynchronously into the main
         # database. These go into the B directory first because we start
         # up in snapshot mode.
@@ -94,12 +265,15 @@ class LocalFilesystem(BaseFilesystem):
         # If the synchronous flag is set then ensure that the
         # B directory is flushed before this method returns.
         if synchronous:
-            # nasty nasty polling implementation. doing this
-            # quickly makes for pleasant unit tests
-            i = 0.01
-            while self.snapshot_code:
-                time.sleep(i)
-                i = min(5, i * 1.1)
+            self.wait_until_recombined()
+
+    def _prepare_journal(self, path):
+        # Place the journal directory at path, if given. Returns true if
+        # the journal is on a different filesystem to the database
+        # directories, so that files can not be renamed between them.
+        if path:
+            raise DirectoryStorageError("[journal]/path is not supported here")
+        return 0
 
     def _init_munger(self, format):
         self.filename_munge = formats[format]
@@ -124,14 +298,14 @@ class LocalFilesystem(BaseFilesystem):
         # many of these writes. We only allow a fixed number of batches to remain
         # unflushed, controlled by _backlog_tokens queue in MultiFlush.
         # This batching can lead to unsmooth peformance under *very* heavy
-        # write pressure. Does anyone see this except in a benchmark? We could
-        # solve this by reducing the size of the thresholds below as the backlog increases.
-        # I wont bother doing this unless someone actually needs it.
+        # write pressure, so FlushController reduces the size of the
+        # thresholds below as the backlog increases.
+        controller = self._flush_controller
         if age > self.flush_interval:
             reason = "age limit reached"
-        elif self._unflushed_total >= self.flush_file_threshold:
+        elif self._unflushed_total >= controller.file_threshold():
             reason = "files limit reached"
-        elif len(self._unflushed) >= self.flush_transaction_threshold:
+        elif len(self._unflushed) >= controller.transaction_threshold():
             reason = "transactions limit reached"
         else:
             return
@@ -159,22 +333,69 @@ class LocalFilesystem(BaseFilesystem):
     def _flusher(self):
         # function which runs in a seperate thread, to asychronously flush
         # files from completed transactions into the main database directory
-        if 0:
-            return
-        while 1:
-            work = self._async_work_queue.get()
-            if self._shutdown_flusher or work is None:
-                return
-            else:
-                try:
-                    work()
-                except:
-                    # Argh! a problem flushing the journal. We must
-                    # *never* flush any more transactions out of the
-                    # journal until this problem has been addressed
-                    self._broken_flusher = 1
-                    self._log_broken_flusher()
-                    raise
+        try:
+            while 1:
+                work = self._async_work_queue.get()
+                if self._shutdown_flusher or work is None:
+                    return
+                else:
+                    try:
+                        work()
+                    except:
+                        # Argh! a problem flushing the journal. We must
+                        # *never* flush any more transactions out of the
+                        # journal until this problem has been addressed
+                        self._broken_flusher = 1
+                        self._log_broken_flusher()
+                        raise
+        finally:
+            # Nobody should wait for us any longer
+            self._flusher_cond.acquire()
+            try:
+                self._flusher_stopped = 1
+                self._flusher_cond.notify_all()
+            finally:
+                self._flusher_cond.release()
+
+    def _notify_flusher_waiters(self, flushed=0):
+        # Called from the flusher thread
+        self._flusher_cond.acquire()
+        try:
+            self._batches_flushed += flushed
+            self._flusher_cond.notify_all()
+        finally:
+            self._flusher_cond.release()
+
+    def wait_until_flushed(self, timeout=None):
+        self._flush_all("wait")
+        self._flusher_cond.acquire()
+        try:
+            target = self._batches_queued
+        finally:
+            self._flusher_cond.release()
+        return self._wait_for_flusher(lambda: self._batches_flushed >= target, timeout)
+
+    def wait_until_recombined(self, timeout=None):
+        return self._wait_for_flusher(lambda: not self.snapshot_code, timeout)
+
+    def _wait_for_flusher(self, done, timeout):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._flusher_cond.acquire()
+        try:
+            while not done():
+                if self._flusher_stopped:
+                    raise DirectoryStorageError("The journal flusher has stopped")
+                if timeout is None:
+                    self._flusher_cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return 0
+                    self._flusher_cond.wait(remaining)
+            return 1
+        finally:
+            self._flusher_cond.release()
 
     def _log_broken_flusher(self):
         try:
@@ -192,46 +413,110 @@ class LocalFilesystem(BaseFilesystem):
             pass
 
     def read_database_file(self, name):
-        self.relocations_lock.acquire()
-        try:
-            return self._do_read_database_file(name)
-        finally:
-            self.relocations_lock.release()
+        # No lock is held here, neither for the relocation lookup nor
+        # for the file IO, so concurrent readers do not serialize behind
+        # each other or behind the flusher.
+        return self._do_read_database_file(name, self.read_file, self.read_file_range)
+
+    def read_database_file_view(self, name):
+        return self._do_read_database_file(
+            name, self.read_file_view, self.read_file_range
+        )
 
-    def _do_read_database_file(self, name):
+    def database_file_size(self, name):
+        return self._do_read_database_file(name, self.file_size, self._range_size)
+
+    def _range_size(self, filename, offset, length):
+        # Check that the record still exists
+        self.file_size(filename)
+        return length
+
+    def _do_read_database_file(self, name, read_file, read_range):
+        # read_file is called with the path of a file, and read_range
+        # with the path, offset and length of a file in a transaction record
         relocated_dir = self.relocations.get(name)
-        if relocated_dir is None:
-            # No relocations....
-            name = self.filename_munge(name)
-            if self.snapshot_code and self._have_flushed:
-                # We are in snapshot mode, so we need to look in
-                # directory B, followed by A
+        while relocated_dir is not None:
+            # a relocation!!!
+            syncer = self._journal_syncer
+            if syncer is not None:
+                # Group commit. The transaction may not be durable yet
+                if type(relocated_dir) is tuple:
+                    syncer.wait_for(relocated_dir[0])
+                else:
+                    syncer.wait_for(relocated_dir)
+            try:
+                if type(relocated_dir) is tuple:
+                    # in a transaction record
+                    path, offset, length = relocated_dir
+                    return read_range(path, offset, length)
+                return read_file(os.path.join(relocated_dir, name))
+            except FileDoesNotExist:
+                # The flusher may have moved this file out of the journal
+                # since we looked up its relocation. It always moves the
+                # file before it removes the relocation, so look again.
+                again = self.relocations.get(name)
+                if again != relocated_dir:
+                    # The relocation has been removed, or replaced by
+                    # a more recent transaction.
+                    relocated_dir = again
+                    continue
+                # The relocation is unchanged, therefore the file has been
+                # moved into the database directory but the relocation has
+                # not been removed yet.
                 try:
-                    return self.read_file(os.path.join("B", name))
+                    return self._read_unrelocated(name, read_file)
                 except FileDoesNotExist:
-                    try:
-                        return self.read_file(os.path.join("A", name))
-                    except FileDoesNotExist:
-                        raise
-            else:
-                # If we are not in snapshot mode, or have not flushed the journal
-                # since entering snapshot mode, then directory A is the only
-                # place we need to look
-                return self.read_file(os.path.join("A", name))
-        else:
-            # a relocation!!!
+                    # The file given in the relocation does not exist?
+                    # something got deleted from the journal directory, or we corrupted
+                    # our relocations database. This is bad.
+                    logger.critical("File missing from journal")
+                    raise FileMissingFromJournalError()
+        # No relocations....
+        return self._read_unrelocated(name, read_file)
+
+    def _read_unrelocated(self, name, read_file):
+        name = self.filename_munge(name)
+        if self.snapshot_code and self._have_flushed:
+            # We are in snapshot mode, so we need to look in
+            # directory B, followed by A
             try:
-                return self.read_file(os.path.join(relocated_dir, name))
+                return read_file(os.path.join("B", name))
             except FileDoesNotExist:
-                # The file given in the relocation does not exist?
-                # something got deleted from the journal directory, or we corrupted
-                # our relocations database. This is bad.
-                logger.critical("File missing from journal")
-                raise FileMissingFromJournalError()
-
-    def _move_to_database_directory(self, sourcedir, dirmap):
-        # Move many files from the journal transaction directory to
-        # an appropriate database directory
+                try:
+                    return read_file(os.path.join("A", name))
+                except FileDoesNotExist:
+                    raise
+        else:
+            # If we are not in snapshot mode, or have not flushed the journal
+            # since entering snapshot mode, then directory A is the only
+            # place we need to look
+            return read_file(os.path.join("A", name))
+
+    def _update_relocations(self, changes):
+        # Replace the relocations mapping with one that includes these
+        # changes. This is called for every commit, and does not copy
+        # the whole mapping.
+        self.relocations_lock.acquire()
+        try:
+            self.relocations = self.relocations.add(changes)
+        finally:
+            self.relocations_lock.release()
+
+    def _remove_relocations(self, moved):
+        # Replace the relocations mapping with one that excludes the names
+        # in this mapping from name to the relocation that was flushed, unless
+        # they have since been relocated somewhere else. This is called once
+        # for each batch flushed.
+        self.relocations_lock.acquire()
+        try:
+            self.relocations = self.relocations.remove(moved)
+        finally:
+            self.relocations_lock.release()
+
+    def _flush_transactions(self, directories):
+        # Move the files of these transactions from the journal to an
+        # appropriate database directory. Returns the number of files in
+        # the transactions, and the number written.
         if self.snapshot_code:
             # First, record the fact that we have flushed so that _do_read_database_file
             # in snapshot mode has to do a little more work.
@@ -239,38 +524,219 @@ class LocalFilesystem(BaseFilesystem):
             dir = "B"
         else:
             dir = "A"
-        for sname in self.listdir(sourcedir):
-            if self._shutdown_flusher:
-                return
-            name = self.filename_munge(sname)
-            directory = os.path.split(name)[0]
-            dest = os.path.join(dir, name)
-            self._check_dir(dest, dirmap)
-            # On ext2 filesystem this is unsafe. The destination
-            # directory has just been created and we are about to
-            # rename comitted files into it. If the system goes down soon
-            # then this directory creation may get lost. If this applies
-            # to you; get a better filesystem.
-            self.relocations_lock.acquire()
+        jobs = []
+        for directory in directories:
+            jobs.extend(self._flush_jobs(directory))
+        if dir == "B" and self._recombine_manifest and jobs:
+            self._append_recombine_manifest(
+                [self.filename_munge(job[1]) for job in jobs]
+            )
+        pool = self._flush_pool
+        if pool is None:
+            moved = {}
             try:
+                written = self._flush_files(
+                    jobs, dir, {}, os.path.join("misc", ".expand"), moved
+                )
+            finally:
+                self._remove_relocations(moved)
+            return len(jobs), written
+        # Split the work between the flush threads by destination directory.
+        # Every copy of a name goes to the same directory, so they are all
+        # handled by one thread in transaction order. Threads may share
+        # ancestor directories, which _check_dir allows for.
+        partitions = [[] for i in range(self.flush_threads)]
+        for job in jobs:
+            parent = os.path.split(self.filename_munge(job[1]))[0]
+            partitions[hash(parent) % len(partitions)].append(job)
+        futures = []
+        moves = []
+        try:
+            for i in range(len(partitions)):
+                if partitions[i]:
+                    temp = os.path.join("misc", ".expand%d" % (i,))
+                    moved = {}
+                    moves.append(moved)
+                    futures.append(
+                        pool.submit(
+                            self._flush_files, partitions[i], dir, {}, temp, moved
+                        )
+                    )
+            wait(futures)
+        finally:
+            # The partitions hold different names, so their moves can be
+            # combined and removed together.
+            moved = {}
+            for m in moves:
+                moved.update(m)
+            self._remove_relocations(moved)
+        written = 0
+        for future in futures:
+            written += future.result()
+        return len(jobs), written
+
+    def _flush_jobs(self, directory):
+        # Returns a list of the files in one transaction, in the form
+        # (transaction, name, extent). extent is None for a file in a
+        # transaction directory. For a file in a transaction record, it is
+        # the record content, and the offset and length of the file.
+        if directory.endswith("_record"):
+            data = self.read_file_view(directory)
+            tid, entries = _parse_record(data, directory)
+            return [
+                (directory, name, (data, offset, length))
+                for name, offset, length in entries
+            ]
+        return [
+            (directory, sname, None)
+            for sname in self.listdir(directory)
+            if sname != MANIFEST
+        ]
+
+    def _flush_files(self, jobs, dir, dirmap, temp, moved):
+        # Returns the number of files written into the database directory.
+        # The rest were overwritten by a later transaction. The relocation
+        # of every file moved is added to moved, for the caller to remove
+        # in one batch once every file is moved. Until then readers find
+        # these files missing from the journal, and look in the database
+        # directory instead.
+        written = 0
+        # Files being copied rather than renamed out of the journal. They
+        # are written without waiting, synced together, and then renamed
+        # into place in journal order.
+        copies = []
+        try:
+            for source, sname, extent in jobs:
+                if self._shutdown_flusher:
+                    return written
+                dest = os.path.join(dir, self.filename_munge(sname))
+                self._check_dir(dest, dirmap)
+                # On ext2 filesystem this is unsafe. The destination
+                # directory has just been created and we are about to
+                # rename comitted files into it. If the system goes down soon
+                # then this directory creation may get lost. If this applies
+                # to you; get a better filesystem.
+                if extent is None:
+                    relocation = source
+                else:
+                    data, offset, length = extent
+                    relocation = source, offset, length
                 relto = self.relocations.get(sname)
-                if relto == sourcedir or relto == None:
+                if relto == relocation or relto == None:
                     # If this record name was previously relocated to the file
                     # we have just moved then we need to move it because it is still
                     # current. If it was not in the relocations map then we must be performing
                     # recovery, and therefore we need to move it into the database directory.
-                    self.overwrite(os.path.join(sourcedir, sname), dest)
-                    # Remove the relocation.
-                    if relto is not None:
-                        del self.relocations[sname]
-                else:
+                    # A transaction finishing concurrently may relocate it again, but
+                    # that is checked when the relocation is removed.
+                    if extent is None and not self.journal_separate:
+                        # Earlier copies of this name must land first
+                        written += self._finish_copies(copies, moved, dirmap)
+                        self._flush_overwrite(os.path.join(source, sname), dest, dirmap)
+                        written += 1
+                        if relto is not None:
+                            moved[sname] = relto
+                        continue
+                    if extent is None:
+                        # Files can not be renamed across filesystems. Copy
+                        # it as for a record, then remove the original so
+                        # that the transaction directory can be removed.
+                        path = os.path.join(source, sname)
+                        content = self.read_file(path)
+                    else:
+                        # Copy it out of the record. It is written to a
+                        # temporary file and then renamed into place, so that
+                        # the database directory never contains a partly
+                        # written file. It is synced because the record will
+                        # be deleted once every file is written.
+                        path = None
+                        content = [memoryview(data)[offset : offset + length]]
+                    name = "%s.%d" % (temp, len(copies))
+                    copies.append(
+                        (self.first_half_write_file(name, content, 1),
+                         name, dest, path, sname, relto)
+                    )
+                    if len(copies) >= FLUSH_COPIES:
+                        written += self._finish_copies(copies, moved, dirmap)
+                elif extent is None:
                     # This record is relocated somewhere else. That means
                     # this record was overwritten while still in the journal.
                     # We could treat it the same as the first branch, but it
                     # is more efficient to remove it.
-                    self.unlink(os.path.join(sourcedir, sname))
-            finally:
-                self.relocations_lock.release()
+                    self.unlink(os.path.join(source, sname))
+                # A file in a transaction record which was overwritten
+                # need not be written at all.
+            written += self._finish_copies(copies, moved, dirmap)
+        finally:
+            # Close any left unfinished by an error or shutdown. Their
+            # originals are still in the journal.
+            for copy in copies:
+                self.abort_half_write_file(copy[0])
+        return written
+
+    def _finish_copies(self, copies, moved, dirmap):
+        # Sync the files copied so far, then rename each into place and
+        # remove its original. Syncing them as a group lets the disk write
+        # them back together, and uses the fsync threads if configured.
+        # Returns the number of files written, and empties copies.
+        if not copies:
+            return 0
+        pool = self._fsync_pool
+        if pool is None or len(copies) < 2:
+            for copy in copies:
+                self.second_half_write_file(copy[0])
+        else:
+            futures = [
+                pool.submit(self.second_half_write_file, copy[0]) for copy in copies
+            ]
+            wait(futures)
+            for future in futures:
+                future.result()
+        written = 0
+        originals = []
+        while copies:
+            half, name, dest, path, sname, relto = copies.pop(0)
+            self._flush_overwrite(name, dest, dirmap)
+            if path is not None:
+                originals.append(path)
+            written += 1
+            if relto is not None:
+                moved[sname] = relto
+        if self.journal_separate:
+            # The journal's filesystem does not order its writes against
+            # ours, so the renames, and any directories created for them,
+            # must be durable before anything is removed from the journal.
+            # That includes the transaction directory or record, which is
+            # removed once the flush is complete. dirmap is emptied so that
+            # only directories touched after this are synced next time.
+            dirmap[os.path.split(name)[0]] = 1
+            for dir in dirmap.keys():
+                self.sync_directory(dir)
+            dirmap.clear()
+        for path in originals:
+            self.unlink(path)
+        return written
+
+    def _flush_overwrite(self, source, dest, dirmap):
+        # Packing removes empty directories from the database directory
+        # while we flush. It forgets each one before removing it, but one
+        # we have just checked, or remembered, can still be removed before
+        # we rename a file into it. Forget it and its ancestors, create
+        # them again, and retry once. The directories checked again are
+        # added to dirmap.
+        try:
+            self.overwrite(source, dest)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            parent = os.path.split(dest)[0]
+            while parent:
+                self.forget_directory(parent)
+                parent = os.path.split(parent)[0]
+            dirs = {}
+            self._check_dir(dest, dirs)
+            dirmap.update(dirs)
+            self.overwrite(source, dest)
 
     def _check_dir(self, file, dirs):
         # make sure that it is possible to write the file by creating any
@@ -281,9 +747,39 @@ class LocalFilesystem(BaseFilesystem):
             return
         if not parent in dirs:
             dirs[parent] = 1
+            self._known_dirs_lock.acquire()
+            try:
+                known = parent in self._known_dirs
+                if known:
+                    self.known_dir_hits += 1
+            finally:
+                self._known_dirs_lock.release()
+            if known:
+                # Its ancestors must exist too
+                return
             if not self.exists(parent):
                 self._check_dir(parent, dirs)
-                self.mkdir(parent)
+                try:
+                    self.mkdir(parent)
+                except EnvironmentError as e:
+                    # Another flush thread may have just created it
+                    if e.errno != errno.EEXIST:
+                        raise
+            if self.known_directories:
+                self._known_dirs_lock.acquire()
+                try:
+                    if len(self._known_dirs) >= self.known_directories:
+                        self._known_dirs = {}
+                    self._known_dirs[parent] = 1
+                finally:
+                    self._known_dirs_lock.release()
+
+    def forget_directory(self, a):
+        self._known_dirs_lock.acquire()
+        try:
+            self._known_dirs.pop(a, None)
+        finally:
+            self._known_dirs_lock.release()
 
     def close(self):
         quick = self.quick_shutdown
@@ -300,8 +796,186 @@ class LocalFilesystem(BaseFilesystem):
         self._async_work_queue.put(None)
         # Wait for the thread to terminate.
         self._flusher.join()
+        if self._fsync_pool is not None:
+            self._fsync_pool.shutdown()
+            self._fsync_pool = None
+        if self._flush_pool is not None:
+            self._flush_pool.shutdown()
+            self._flush_pool = None
+        if self._relaxed_syncer is not None:
+            self._relaxed_syncer.close()
+            logger.log(
+                self.ENGINE_NOISE,
+                "Relaxed journal sync: %(transactions)d transactions "
+                "in %(batches)d batches" % self._relaxed_syncer.report(),
+            )
+        if self._flush_controller.batches:
+            logger.log(
+                self.ENGINE_NOISE,
+                "Journal flush: %(batches)d batches, %(stalls)d stalls, "
+                "%(stall_seconds).3f seconds stalled, "
+                "%(max_stall_seconds).3f seconds maximum" % self.flush_report(),
+            )
+        if self.fsync_commits:
+            logger.log(
+                self.ENGINE_NOISE,
+                "Journal sync: %(commits)d commits, %(seconds).3f seconds, "
+                "%(max_seconds).3f seconds maximum" % self.fsync_report(),
+            )
+
+    def _record_fsync_time(self, seconds):
+        # Called with the commit lock held
+        self.fsync_commits += 1
+        self.fsync_seconds += seconds
+        if seconds > self.fsync_max_seconds:
+            self.fsync_max_seconds = seconds
+
+    def fsync_report(self):
+        return {
+            "commits": self.fsync_commits,
+            "seconds": self.fsync_seconds,
+            "max_seconds": self.fsync_max_seconds,
+        }
+
+    def _record_flush(self, files, written, seconds):
+        # Called from the flusher thread
+        self.flushed_batches += 1
+        self.flushed_files += written
+        self.elided_files += files - written
+        self.flush_seconds += seconds
+        if seconds > self.flush_max_seconds:
+            self.flush_max_seconds = seconds
+
+    def stats(self):
+        # How far the flusher is behind, and what it has done so far
+        stats = {
+            "unflushed_transactions": len(self._unflushed),
+            "unflushed_files": self._unflushed_total,
+            "backlog_tokens": self._backlog_tokens.qsize(),
+            "work_queue": self._async_work_queue.qsize(),
+            "relocations": len(self.relocations),
+            "snapshot_code": self.snapshot_code,
+            "flushed_batches": self.flushed_batches,
+            "flushed_files": self.flushed_files,
+            "elided_files": self.elided_files,
+            "flush_seconds": self.flush_seconds,
+            "flush_max_seconds": self.flush_max_seconds,
+        }
+        for k, v in self.flush_report().items():
+            stats["flush_" + k] = v
+        for k, v in self.fsync_report().items():
+            stats["fsync_" + k] = v
+        if self._relaxed_syncer is not None:
+            for k, v in self._relaxed_syncer.report().items():
+                stats["relaxed_" + k] = v
+        return stats
+
+    def flush_report(self):
+        report = self._flush_controller.report()
+        report["directory_stats_saved"] = self.known_dir_hits
+        return report
+
+    def _write_synced_mark(self, tid):
+        # Record that every transaction up to this one, committed with
+        # relaxed durability, has been synced.
+        self.write_file("misc/.synced", oid2str(tid).encode("ascii"))
+        self.overwrite("misc/.synced", "misc/synced")
+        self.sync_directory("misc")
+
+    _transaction_directory_re = re.compile(
+        "^working_([A-F0-9]{16})_((?:temp)|(?:done)|(?:record)|(?:lazy))"
+    )
+    _slot_re = re.compile("^slot_([0-9]+)$")
+
+    def _claim_slot(self):
+        # Return an empty directory in the journal for a new transaction.
+        # With a pool of slots this avoids creating a directory for every
+        # transaction, and removing it once the transaction is flushed.
+        self._slot_lock.acquire()
+        try:
+            if self._free_slots:
+                return self._free_slots.pop()
+            name = os.path.join("journal", "slot_%d" % (self._next_slot,))
+            self._next_slot += 1
+        finally:
+            self._slot_lock.release()
+        self.mkdir(name)
+        return name
+
+    def _release_slot(self, path):
+        # Return a directory to the pool, if it is not already full. This
+        # rename does not need to be durable. If it is lost in a crash then
+        # recovery finds an empty transaction directory, and removes it.
+        for file in self.listdir(path):
+            # Something was left behind. Dont reuse it; recovery will
+            # clean it up
+            return
+        self._slot_lock.acquire()
+        try:
+            if len(self._free_slots) >= self.journal_slots:
+                name = None
+            else:
+                name = os.path.join("journal", "slot_%d" % (self._next_slot,))
+                self._next_slot += 1
+        finally:
+            self._slot_lock.release()
+        if name is None:
+            self.rmdir(path)
+            return
+        self.rename(path, name)
+        self._slot_lock.acquire()
+        try:
+            self._free_slots.append(name)
+        finally:
+            self._slot_lock.release()
 
-    _transaction_directory_re = re.compile("^working_[A-F0-9]{16}_((?:temp)|(?:done))")
+    def _remove_transaction_directory(self, path):
+        # Called by the flusher once every file has been moved out
+        if path.endswith("_lazy"):
+            self.unlink(os.path.join(path, MANIFEST))
+        if self.journal_slots:
+            self._release_slot(path)
+        else:
+            self.rmdir(path)
+
+    def _recover_slots(self, slots):
+        # Called during recovery with the names of every slot directory.
+        # A slot containing files was in use by a transaction that did not
+        # commit, or whose rename into its committed name was lost. Returns
+        # a list with the transaction id of each such transaction, as used
+        # in transaction directory names, or None if it is not known.
+        used = []
+        for file in slots:
+            path = os.path.join("journal", file)
+            names = self.listdir(path)
+            if names:
+                try:
+                    tid = self.read_file(os.path.join(path, "x.serial"))
+                except FileDoesNotExist:
+                    tid = b""
+                if len(tid) == 8:
+                    used.append(oid2str(tid))
+                else:
+                    used.append(None)
+            for name in names:
+                self.unlink(os.path.join(path, name))
+            number = int(self._slot_re.match(file).group(1))
+            self._next_slot = max(self._next_slot, number + 1)
+            if len(self._free_slots) < self.journal_slots:
+                self._free_slots.append(path)
+            else:
+                self.rmdir(path)
+        # Create the rest of the pool now, rather than while committing
+        created = 0
+        while len(self._free_slots) < self.journal_slots:
+            name = os.path.join("journal", "slot_%d" % (self._next_slot,))
+            self._next_slot += 1
+            self.mkdir(name)
+            self._free_slots.append(name)
+            created = 1
+        if created:
+            self.sync_directory("journal")
+        return used
 
     def _recovery(self):
         # This is called at startup to flush any changes remaining
@@ -311,6 +985,9 @@ class LocalFilesystem(BaseFilesystem):
         # flushed into the B directory
         jc = [x for x in self.listdir("journal")]
         jc.sort()  # alphabetic sort order will give us jounal replay order too
+        slots = [x for x in jc if self._slot_re.match(x)]
+        jc = [x for x in jc if not self._slot_re.match(x)]
+        used_slots = self._recover_slots(slots)
 
         # Should we check that the journal directory names correspond to transactions
         # that are more recent than what we believe to be the most recent flushed transaction?
@@ -330,24 +1007,98 @@ class LocalFilesystem(BaseFilesystem):
         strange = []
         to_flush = []
         to_delete = []
+        torn = None
+        try:
+            synced = self.read_file("misc/synced").decode("ascii")
+        except FileDoesNotExist:
+            synced = ""
+        # A transaction left under its temporary name, or in a slot, may
+        # have been committed with relaxed durability and then lost its
+        # rename in the crash. Unless misc/synced shows that it was synced,
+        # any later transaction committed lazily may depend on it, so it
+        # is discarded too. lost is the id of the earliest such transaction.
+        # The id of a slot's transaction is read from its x.serial file; if
+        # that is missing, every unsynced transaction is suspect.
+        lost = None
+        for tid in used_slots:
+            if tid is None:
+                tid = synced
+            elif tid <= synced:
+                continue
+            if lost is None or tid < lost:
+                lost = tid
         for file in jc:
             match = self._transaction_directory_re.match(file)
-            if not match:
+            if match and match.group(2) == "temp" and match.group(1) > synced:
+                if lost is None or match.group(1) < lost:
+                    lost = match.group(1)
+        for file in jc:
+            match = self._transaction_directory_re.match(file)
+            if file == ".replica.incoming":
+                # Part of a replica increment, downloaded straight into a
+                # journal on a separate filesystem before a crash
+                to_delete.append(file)
+            elif not match:
                 strange.append(file)
-            elif match.group(1) == "done":
-                to_flush.append(file)
-            else:
+            elif match.group(2) == "temp":
                 to_delete.append(file)
+            elif (
+                lost is not None
+                and match.group(1) > lost
+                and (
+                    match.group(2) == "lazy"
+                    or (match.group(2) == "record" and self._relaxed_syncer is not None)
+                )
+            ):
+                # Committed lazily after a transaction whose commit may
+                # have been lost. Transactions committed with full
+                # durability are kept, because none of them could read a
+                # transaction before it was durable.
+                logger.error(
+                    "Discarding %s, which follows a transaction that may "
+                    "have been lost" % (file,)
+                )
+                to_delete.append(file)
+            elif torn:
+                # A transaction which follows a torn transaction. Its
+                # predecessor never committed, therefore neither did this.
+                logger.error("Discarding %s, which follows a torn transaction" % (file,))
+                to_delete.append(file)
+            elif match.group(2) == "record" and not self._record_is_complete(file):
+                # A record which was not completely written before a crash.
+                logger.error("Discarding torn transaction record %s" % (file,))
+                to_delete.append(file)
+                torn = file
+            elif (
+                match.group(2) == "lazy"
+                and match.group(1) > synced
+                and not self._lazy_transaction_is_complete(file)
+            ):
+                # A transaction committed with relaxed durability, which
+                # was not completely synced before a crash.
+                logger.error("Discarding torn transaction %s" % (file,))
+                to_delete.append(file)
+                torn = file
+            else:
+                to_flush.append(file)
         if strange:
             raise RecoveryError("unexpected files in journal directory: %r" % (strange))
         # For every directory that we want to keep...
         paths = []
+        changes = {}
         for file in to_flush:
             # add every file in the directory into the relocations mapping.
             path = os.path.join("journal", file)
             paths.append(path)
-            for file in self.listdir(path):
-                self.relocations[file] = path
+            if file.endswith("_record"):
+                tid, entries = _parse_record(self.read_file(path), path)
+                for name, offset, length in entries:
+                    changes[name] = path, offset, length
+            else:
+                for file in self.listdir(path):
+                    if file != MANIFEST:
+                        changes[file] = path
+        self._update_relocations(changes)
         # Asynchonously move good files into the main directory
         MultiFlush(paths, self, "recovery").go()
         # And ansynchronously delete bad ones
@@ -356,11 +1107,37 @@ class LocalFilesystem(BaseFilesystem):
             t.setDaemon(1)
             t.start()
 
+    def _record_is_complete(self, file):
+        try:
+            _parse_record(self.read_file(os.path.join("journal", file)), file)
+        except TornRecordError:
+            return 0
+        return 1
+
+    def _lazy_transaction_is_complete(self, file):
+        # Check every file against the manifest
+        path = os.path.join("journal", file)
+        try:
+            manifest = _parse_manifest(self.read_file(os.path.join(path, MANIFEST)))
+            if manifest is None:
+                return 0
+            for name, (length, crc) in manifest.items():
+                data = self.read_file(os.path.join(path, name))
+                if len(data) != length or zlib.crc32(data) != crc:
+                    return 0
+        except FileDoesNotExist:
+            return 0
+        return 1
+
     def _delete(self, to_delete):
         # for every directory that we want to delete
         for file in to_delete:
-            # ... delete its contents
             path = os.path.join("journal", file)
+            if not self.isdir(path):
+                # a transaction record, or its temporary file
+                self.unlink(path)
+                continue
+            # ... delete its contents
             for file in self.listdir(path):
                 self.unlink(os.path.join(path, file))
             # ... and delete the directory
@@ -399,7 +1176,15 @@ class LocalFilesystem(BaseFilesystem):
         # Keeping the file around until the next replica is handy for
         # debugging, plus its mtime is useful if you need to know
         # when you last replicated.
-        self.rename("journal/replica.tar", "misc/replica.previous")
+        if self.journal_separate:
+            # It can not be renamed across filesystems
+            shutil.copy2(
+                os.path.join(self.dirname, "journal/replica.tar"),
+                os.path.join(self.dirname, "misc/replica.previous"),
+            )
+            self.unlink("journal/replica.tar")
+        else:
+            self.rename("journal/replica.tar", "misc/replica.previous")
         self.sync_directory("journal")
         logger.log(self.ENGINE_NOISE, "Flushed %d files from replica" % (c,))
 
@@ -440,6 +1225,100 @@ class LocalFilesystem(BaseFilesystem):
         self.snapshot_code = code
         self._snapshot_ack.release()
 
+    def clone_snapshot(self, code):
+        # Create a point-in-time copy of the A directory in
+        # misc/snapshots/code, and return its path. Snapshot mode is only
+        # held while every file is cloned, not while the copy is used.
+        # Files in the copy are reflink copies of the files in A, or hard
+        # links to them. Files in A are replaced rather than modified,
+        # except by patch_file which allows for this.
+        #
+        # The copy is not synced, so it may be incomplete after a system
+        # crash. Copies older than clone_max_age seconds are removed when
+        # the next one is made.
+        if not code or os.sep in code or code.startswith("."):
+            raise DirectoryStorageError("Bad snapshot clone name %r" % (code,))
+        path = os.path.join(SNAPSHOTS, code)
+        # Built under another name, so that a clone is complete if it exists
+        partial = os.path.join(SNAPSHOTS, "." + code)
+        self.enter_snapshot("clone/" + code)
+        try:
+            # Entering snapshot mode also ensures nobody else is cloning
+            if self.exists(SNAPSHOTS):
+                self._reap_snapshot_clones()
+            else:
+                self.mkdir(SNAPSHOTS)
+            if self.exists(path):
+                raise DirectoryStorageError("Snapshot clone %r already exists" % (code,))
+            self.mkdir(partial)
+            count = self._clone_tree("A", partial)
+            # Still in snapshot mode, so that the next clone can not reap
+            # the partial copy from under us
+            self.rename(partial, path)
+        finally:
+            self.leave_snapshot("clone/" + code)
+        logger.log(
+            self.ENGINE_NOISE, "Cloned %d files into snapshot %r" % (count, code)
+        )
+        return path
+
+    def _clone_tree(self, source, dest):
+        count = 0
+        for file in self.listdir(source):
+            s = os.path.join(source, file)
+            d = os.path.join(dest, file)
+            if self.isdir(s):
+                self.mkdir(d)
+                count += self._clone_tree(s, d)
+            else:
+                self.clone_file(s, d)
+                count += 1
+        return count
+
+    def remove_snapshot_clone(self, code):
+        if not code or os.sep in code or code.startswith("."):
+            raise DirectoryStorageError("Bad snapshot clone name %r" % (code,))
+        path = os.path.join(SNAPSHOTS, code)
+        if not self.exists(path):
+            raise DirectoryStorageError("No snapshot clone %r" % (code,))
+        self._remove_tree(path)
+
+    def _reap_snapshot_clones(self):
+        # Called in snapshot mode. Remove clones which were left partly
+        # built, and any older than clone_max_age
+        now = time.time()
+        for file in self.listdir(SNAPSHOTS):
+            path = os.path.join(SNAPSHOTS, file)
+            if file.startswith("."):
+                logger.info("Removing partial snapshot clone %r" % (file[1:],))
+            elif self.clone_max_age and (
+                self.modification_time(path) + self.clone_max_age < now
+            ):
+                logger.info("Removing old snapshot clone %r" % (file,))
+            else:
+                continue
+            self._remove_tree(path)
+
+    def _remove_tree(self, path):
+        for file in self.listdir(path):
+            p = os.path.join(path, file)
+            if self.isdir(p):
+                self._remove_tree(p)
+            else:
+                self.unlink(p)
+        self.rmdir(path)
+
+    def patch_file(self, filename, offset, content):
+        # A snapshot clone may share this file through a hard link. While
+        # there are clones, the change is made to a new copy of the file.
+        if not (self.exists(SNAPSHOTS) and self.listdir(SNAPSHOTS)):
+            return self.modify_file(filename, offset, content)
+        data = self.read_file(filename)
+        data = data[:offset] + content + data[offset + len(content) :]
+        temp = os.path.join("misc", ".patch")
+        self.write_file(temp, data)
+        self.overwrite(temp, filename)
+
     def leave_snapshot(self, code):
         if code != self.snapshot_code:
             raise DirectoryStorageError("bad code %r!=%r" % (code, self.snapshot_code))
@@ -470,22 +1349,115 @@ class LocalFilesystem(BaseFilesystem):
         # Called from the flusher thread.
         if counter is None:
             counter = self.flush_file_threshold
-        try:
-            self._recombine_dir(".", counter)
-        except QuickExitFromRecombine:
-            # Push outselves onto the back of the work queue
-            # Escalate the number of files checked each time, to ensure
-            # that recombination finishes in bounded time
-            self._async_work_queue.put(lambda: self._recombine(1 + int(counter * 1.4)))
+        if self._recombine_manifest:
+            if not self._recombine_from_manifest(counter):
+                # Push outselves onto the back of the work queue. We carry
+                # on from where we left off in the manifest.
+                self._async_work_queue.put(self._recombine)
+                return
         else:
-            # B directory is currently empty, and we must ensure that it
-            # stays that way before we start flushing the journal into A
-            self.sync_directory("B")
-            logger.log(
-                self.ENGINE_NOISE, "Left snapshot mode %r" % (self.snapshot_code,)
+            try:
+                self._recombine_dir(".", counter)
+            except QuickExitFromRecombine:
+                # Push outselves onto the back of the work queue
+                # Escalate the number of files checked each time, to ensure
+                # that recombination finishes in bounded time
+                self._async_work_queue.put(
+                    lambda: self._recombine(1 + int(counter * 1.4))
+                )
+                return
+            # Now that B is empty, the manifest can list everything in it
+            self._recombine_manifest = 1
+        # B directory is currently empty, and we must ensure that it
+        # stays that way before we start flushing the journal into A
+        self.sync_directory("B")
+        if self._recombine_manifest_size:
+            # Nothing more is flushed into B until the next snapshot. This
+            # is removed first so that anyone waiting for recombination
+            # finds it gone.
+            self.unlink(RECOMBINE_MANIFEST)
+            self._recombine_manifest_size = 0
+            self._recombine_offset = 0
+        logger.log(self.ENGINE_NOISE, "Left snapshot mode %r" % (self.snapshot_code,))
+        self.snapshot_code = None
+        self._have_flushed = 0
+        self._notify_flusher_waiters()
+
+    def _append_recombine_manifest(self, paths):
+        # Called from the flusher thread, with the paths under B of files
+        # that it is about to move there. The manifest is synced before
+        # any of them are moved, so that it lists every file in B even
+        # after a crash. Each append starts with a newline, which ends a
+        # line torn by a crash during the previous one.
+        content = ("\n" + "\n".join(paths) + "\n").encode("ascii")
+        created = not self._recombine_manifest_size
+        self.modify_file(RECOMBINE_MANIFEST, self._recombine_manifest_size, content)
+        self._recombine_manifest_size += len(content)
+        if self.use_sync:
+            self.sync_file(RECOMBINE_MANIFEST)
+            if created:
+                self.sync_directory("misc")
+
+    def _recombine_from_manifest(self, counter):
+        # Move up to counter files listed in the manifest from B into A.
+        # Returns true once every file has been moved. After a restart we
+        # start again from the beginning of the manifest; files which have
+        # already been moved are no longer in B, and are skipped.
+        while self._recombine_offset < self._recombine_manifest_size:
+            length = min(self._recombine_manifest_size - self._recombine_offset, 65536)
+            data = bytes(
+                self.read_file_range(RECOMBINE_MANIFEST, self._recombine_offset, length)
             )
-            self.snapshot_code = None
-            self._have_flushed = 0
+            lines = data.split(b"\n")[:-1]
+            if not lines:
+                # A line torn by a crash, at the very end of the manifest
+                self._recombine_offset = self._recombine_manifest_size
+                break
+            for line in lines:
+                self._recombine_offset += len(line) + 1
+                if line:
+                    path = _manifest_path(line)
+                    if path is None:
+                        # An append torn by a crash, completed by the
+                        # newline which starts the next one
+                        logger.warning(
+                            "Skipping bad line %r in the recombine manifest" % (line,)
+                        )
+                        continue
+                    self._recombine_path(path)
+                    counter -= 1
+                    if not counter:
+                        # Having dealt with our quota of files it is time to
+                        # free up the flusher thread and check the journal.
+                        return 0
+        # Every file is in A. Remove the directories left behind in B,
+        # deepest first.
+        dirs = sorted(self._recombined_dirs, key=lambda d: -d.count(os.sep))
+        for directory in dirs:
+            b = os.path.join("B", directory)
+            try:
+                self.rmdir(b)
+            except EnvironmentError:
+                # Already removed before a restart, or something unexpected
+                # is still in there
+                pass
+            self.forget_directory(b)
+        self._recombined_dirs = {}
+        return 1
+
+    def _recombine_path(self, path):
+        parent = os.path.split(path)[0]
+        while parent and parent not in self._recombined_dirs:
+            self._recombined_dirs[parent] = 1
+            parent = os.path.split(parent)[0]
+        b = os.path.join("B", path)
+        if not self.exists(b):
+            # Listed again by a later flush, moved before a restart, or
+            # the flusher stopped before moving it
+            return
+        a = os.path.join("A", path)
+        self._check_dir(a, {})
+        self.overwrite(b, a)
 
     def _recombine_dir(self, directory, counter):
         for file in self.listdir(os.path.join("B", directory)):
@@ -497,6 +1469,7 @@ class LocalFilesystem(BaseFilesystem):
                 self._check_dir(os.path.join(a, "xxxxx"), {})
                 counter = self._recombine_dir(path, counter)
                 self.rmdir(b)
+                self.forget_directory(b)
             else:
                 self.overwrite(b, os.path.join("A", path))
                 if counter:
@@ -506,11 +1479,13 @@ class LocalFilesystem(BaseFilesystem):
                         # free up the flusher thread and check the journal.
                         raise QuickExitFromRecombine()
 
-    def first_half_write_file(self, filename, content):
+    def first_half_write_file(self, filename, content, keep_open=0):
         # Write those bytes to the specified file, and return an object
         # that can be passed to second_half_write_file or
         # abort_half_write_file
         # Many writes will overlap
+        # keep_open is a hint that the file may be kept open until then,
+        # if that saves reopening it.
         raise NotImplementedError("first_half_write_file")
 
     def second_half_write_file(self, cookie):
@@ -533,13 +1508,26 @@ class LocalFilesystemTransaction(BaseFilesystemTransaction):
         self.tid = tid
         # the name of our transaction directory
         dirname = oid2str(tid)
-        self.temp_name = os.path.join("journal", "working_%s_temp" % (dirname,))
-        self.done_name = os.path.join("journal", "working_%s_done" % (dirname,))
+        if filesystem.journal_slots:
+            self.temp_name = filesystem._claim_slot()
+        else:
+            self.temp_name = os.path.join("journal", "working_%s_temp" % (dirname,))
+            # create a transaction directory inside the journal directory
+            self.filesystem.mkdir(self.temp_name)
+        if filesystem._relaxed_syncer is None:
+            self.done_name = os.path.join("journal", "working_%s_done" % (dirname,))
+            self.manifest = None
+        else:
+            # Relaxed durability. The directory is renamed to this name
+            # without syncing anything. Its manifest, a mapping from name to
+            # length and crc32, lets recovery find whether it is complete.
+            self.done_name = os.path.join("journal", "working_%s_lazy" % (dirname,))
+            self.manifest = {}
         self.curr_name = self.temp_name
         # mapping from name to pair of sort key and half written file in the transaction directory
         self.names = {}
-        # create a transaction directory inside the journal directory
-        self.filesystem.mkdir(self.temp_name)
+        # Our turn in the journal directory sync, if using group commit
+        self.ticket = None
 
     def write(self, name, data):
         file = self.filesystem.first_half_write_file(
@@ -550,6 +1538,8 @@ class LocalFilesystemTransaction(BaseFilesystemTransaction):
             self.filesystem.abort_half_write_file(old[1])
         pair = len(self.names), file
         self.names[name] = pair
+        if self.manifest is not None:
+            self.manifest[name] = content_length(data), content_crc32(data)
 
     def vote(self):
         # Should we rename the directory to working_xxxx_vote in here? That would mean we
@@ -561,43 +1551,66 @@ class LocalFilesystemTransaction(BaseFilesystemTransaction):
         pass
 
     def finish(self):
-        # First, sync all our files: body and inode
-        # Do this in write order
-        unwritten = list(self.names.values())
-        unwritten.sort()
-        for f in unwritten:
-            self.filesystem.second_half_write_file(f[1])
-        # sync the transaction directory. at this point
-        # only the journal directory remains unsynced
-        self.filesystem.sync_directory(self.temp_name)
+        if self.manifest is None:
+            self._sync_files()
+        else:
+            # Relaxed durability. Close the files without syncing them,
+            # and leave the syncing to the RelaxedSyncer.
+            for f in list(self.names.values()):
+                self.filesystem.abort_half_write_file(f[1])
+            f = self.filesystem.first_half_write_file(
+                os.path.join(self.temp_name, MANIFEST), _make_manifest(self.manifest)
+            )
+            self.filesystem.abort_half_write_file(f)
         # rename the directory so that recovery knows the
         # transaction has been committed
         self.filesystem.rename(self.temp_name, self.done_name)
-        # sync the journal directory, the directory which contains
-        # the transaction directory. everything is now safe
-        self.filesystem.sync_directory("journal")
         # register the transaction directory as containing the current
         # copy of all of these files, in case they have to be read
         # before the flush is complete.
         changes = {}
         for name in list(self.names.keys()):
             changes[name] = self.done_name
-        # Dont update relocations while another thread is entering snapshot mode.
-        # They need the journal to be empty, to ensure that all files are properly flushed
-        # into the snapshot
-        lock1 = self.filesystem._snapshot_lock
-        # Dont update relocations while another thread is not be expecting it
-        lock2 = self.filesystem.relocations_lock
-        lock1.acquire()
-        lock2.acquire()
-        try:
-            self.filesystem.relocations.update(changes)
-        finally:
-            lock2.release()
-            lock1.release()
-        # flush the journal directory asynchronously. This will be
-        # done in directory order
-        self.filesystem._add_to_flush_queue(self)
+        _committed(self, changes)
+
+    def sync(self):
+        # Called by the RelaxedSyncer, after finish
+        for name in list(self.names.keys()) + [MANIFEST]:
+            self.filesystem.sync_file(os.path.join(self.done_name, name))
+        self.filesystem.sync_directory(self.done_name)
+
+    def _sync_files(self):
+        start = time.time()
+        # First, sync all our files: body and inode
+        # Do this in write order
+        unwritten = list(self.names.values())
+        unwritten.sort(key=lambda f: f[0])
+        pool = self.filesystem._fsync_pool
+        if pool is None or len(unwritten) < 2:
+            for f in unwritten:
+                self.filesystem.second_half_write_file(f[1])
+        else:
+            # Sync them concurrently, which is much faster on devices
+            # that can service many requests at once. Order does not
+            # matter, as long as they are all finished before the rename.
+            futures = [
+                pool.submit(self.filesystem.second_half_write_file, f[1])
+                for f in unwritten
+            ]
+            wait(futures)
+            for future in futures:
+                future.result()
+        # sync the transaction directory. at this point
+        # only the journal directory remains unsynced
+        self.filesystem.sync_directory(self.temp_name)
+        self.filesystem._record_fsync_time(time.time() - start)
+
+    def wait_until_durable(self):
+        if self.ticket is not None:
+            self.filesystem._journal_syncer.wait(self.ticket)
+
+    def awaiting_sync(self):
+        return self.ticket is not None
 
     def abort(self):
         # close any files we might still have open
@@ -612,11 +1625,278 @@ class LocalFilesystemTransaction(BaseFilesystemTransaction):
                 pass
         # delete the transaction directory
         try:
-            self.filesystem.rmdir(self.temp_name)
+            if self.filesystem.journal_slots:
+                self.filesystem._release_slot(self.temp_name)
+            else:
+                self.filesystem.rmdir(self.temp_name)
         except EnvironmentError:
             pass
 
 
+def _committed(transaction, changes):
+    # Called from finish, once the transaction has been renamed into its
+    # committed name in the journal. changes maps the names of the files
+    # written in the transaction to their relocations.
+    fs = transaction.filesystem
+    # sync the journal directory, the directory which contains
+    # the transaction. everything is now safe
+    syncer = fs._journal_syncer
+    if fs._relaxed_syncer is not None:
+        # Relaxed durability. The transaction is synced in the background
+        fs._relaxed_syncer.add(transaction)
+    elif syncer is None:
+        fs.sync_directory("journal")
+    else:
+        # Group commit. The sync is shared with other transactions
+        # finishing at about the same time, and happens after the
+        # storage has released its commit lock. See wait_until_durable.
+        # Until then, anything reading this transaction's files waits
+        # for that sync, so no reader and no later transaction can see
+        # it before it is durable.
+        transaction.ticket = syncer.request(transaction.done_name)
+    # Dont update relocations while another thread is entering snapshot mode.
+    # They need the journal to be empty, to ensure that all files are properly flushed
+    # into the snapshot
+    lock1 = fs._snapshot_lock
+    lock1.acquire()
+    try:
+        fs._update_relocations(changes)
+    finally:
+        lock1.release()
+    # flush the journal directory asynchronously. This will be
+    # done in directory order
+    fs._add_to_flush_queue(transaction)
+
+
+class LocalRecordTransaction(BaseFilesystemTransaction):
+    # A transaction in the 'record' journal format. Rather than a directory
+    # containing one file for each name written, the transaction is one
+    # record file in the journal. It is written and synced in a single
+    # operation during vote, then renamed into its committed name by
+    # finish. A record is laid out as:
+    #
+    #   0:4    RMAGIC
+    #   4:12   length of the whole record
+    #   12:20  transaction id
+    #   20     checksum algorithm tag, as for object files
+    #   21:24  reserved, zero
+    #   24:40  checksum of everything from byte 40
+    #   40:    for each file, the length of its name (2 bytes), the length
+    #          of its data (4 bytes), its name, and its data.
+    #
+    # A record is always checksummed, so that recovery can recognise a
+    # record that was not completely written.
+
+    def __init__(self, filesystem, tid):
+        self.filesystem = filesystem
+        self.tid = tid
+        strtid = oid2str(tid)
+        self.temp_name = os.path.join("journal", "working_%s_temp" % (strtid,))
+        self.done_name = os.path.join("journal", "working_%s_record" % (strtid,))
+        # mapping from name to data, in write order
+        self.names = {}
+        self.ticket = None
+        self._entries = None
+
+    def write(self, name, data):
+        self.names[name] = data
+
+    def vote(self):
+        record, self._entries = _make_record(
+            self.tid, self.names, self.filesystem._record_checksum_tag
+        )
+        if self.filesystem._relaxed_syncer is not None:
+            # Relaxed durability. Recovery uses the record checksum
+            # to find whether it was completely written.
+            f = self.filesystem.first_half_write_file(self.temp_name, record)
+            self.filesystem.abort_half_write_file(f)
+            return
+        start = time.time()
+        self.filesystem.write_file(self.temp_name, record)
+        self.filesystem._record_fsync_time(time.time() - start)
+
+    def finish(self):
+        self.filesystem.rename(self.temp_name, self.done_name)
+        changes = {}
+        for name, offset, length in self._entries:
+            changes[name] = self.done_name, offset, length
+        # The data is now in the record, and no longer needed in memory.
+        # names is kept for its length
+        self.names = dict.fromkeys(self.names)
+        _committed(self, changes)
+
+    def wait_until_durable(self):
+        if self.ticket is not None:
+            self.filesystem._journal_syncer.wait(self.ticket)
+
+    def awaiting_sync(self):
+        return self.ticket is not None
+
+    def sync(self):
+        # Called by the RelaxedSyncer, after finish
+        self.filesystem.sync_file(self.done_name)
+
+    def abort(self):
+        if self._entries is not None:
+            try:
+                self.filesystem.unlink(self.temp_name)
+            except EnvironmentError:
+                pass
+
+
+def _make_record(tid, names, tag):
+    # Returns the record file content as a list of buffers, and a list of
+    # the name, offset and length of each file in it
+    chunks = [None]
+    entries = []
+    offset = 40
+    c = checksums.new(tag)
+    for name, data in names.items():
+        bname = name.encode("ascii")
+        length = content_length(data)
+        prefix = struct.pack("!HI", len(bname), length) + bname
+        if type(data) is list:
+            parts = [prefix] + data
+        else:
+            parts = [prefix, data]
+        for part in parts:
+            c.update(part)
+        chunks.extend(parts)
+        offset += len(prefix)
+        entries.append((name, offset, length))
+        offset += length
+    header = RMAGIC + struct.pack("!Q", offset) + tid + struct.pack("!B3x", tag)
+    chunks[0] = header + c.digest()
+    return chunks, entries
+
+
+def _make_manifest(manifest):
+    # The manifest of a transaction directory committed with relaxed
+    # durability. One line for each file with its name, length and crc32,
+    # then a line with the crc32 of those lines.
+    lines = []
+    for name, (length, crc) in manifest.items():
+        lines.append("%s %d %d\n" % (name, length, crc))
+    body = "".join(lines).encode("ascii")
+    return body + b"end %d\n" % (zlib.crc32(body),)
+
+
+def _parse_manifest(data):
+    # Returns the mapping from name to length and crc32, or None if the
+    # manifest is incomplete
+    if not data.endswith(b"\n"):
+        return None
+    lines = data.split(b"\n")[:-1]
+    body = data[: len(data) - len(lines[-1]) - 1]
+    if lines[-1] != b"end %d" % (zlib.crc32(body),):
+        return None
+    manifest = {}
+    for line in lines[:-1]:
+        name, length, crc = line.decode("ascii").split(" ")
+        manifest[name] = int(length), int(crc)
+    return manifest
+
+
+def _manifest_path(line):
+    # Returns the path named by one line of the recombine manifest, or
+    # None if it is not a path relative to B, such as the junk left by a
+    # torn append
+    try:
+        path = line.decode("ascii")
+    except UnicodeDecodeError:
+        return None
+    if "\0" in path:
+        return None
+    for part in path.split(os.sep):
+        if part in ("", ".", ".."):
+            return None
+    return path
+
+
+def _parse_record(data, name):
+    # Check a record, and return its transaction id and a list of the name,
+    # offset and length of each file in it. Raises TornRecordError if the
+    # record is incomplete or fails its checksum.
+    if len(data) < 40 or data[:4] != RMAGIC:
+        raise TornRecordError("Bad transaction record header in %r" % (name,))
+    length = struct.unpack("!Q", data[4:12])[0]
+    if length != len(data):
+        raise TornRecordError("Wrong length of transaction record %r" % (name,))
+    if checksums.checksum(data[20], data[40:]) != data[24:40]:
+        raise TornRecordError("Checksum error in transaction record %r" % (name,))
+    tid = bytes(data[12:20])
+    entries = []
+    offset = 40
+    while offset < length:
+        lname, ldata = struct.unpack("!HI", data[offset : offset + 6])
+        offset += 6
+        fname = bytes(data[offset : offset + lname]).decode("ascii")
+        offset += lname
+        entries.append((fname, offset, ldata))
+        offset += ldata
+    return tid, entries
+
+
+class RelocationMap:
+    # An immutable mapping from name to relocation. It is a stack of
+    # dictionaries, newest first, and a name takes its value from the first
+    # one containing it. Adding the changes of a transaction makes a new map
+    # which shares the older dictionaries, so a commit does not copy every
+    # relocation. The new dictionary is merged with those below it while
+    # they are no more than twice its size, which keeps the stack short.
+    # A name is only copied into a dictionary at least half as large again,
+    # so it is copied a logarithmic number of times, not once per commit.
+    # Removing names, which happens once per flush, flattens the stack.
+
+    def __init__(self, layers=()):
+        self._layers = layers
+
+    def get(self, name, default=None):
+        for layer in self._layers:
+            value = layer.get(name)
+            if value is not None:
+                return value
+        return default
+
+    def __len__(self):
+        if len(self._layers) == 1:
+            return len(self._layers[0])
+        return len(self._flatten())
+
+    def add(self, changes):
+        # Returns a new map including these changes. The changes dictionary
+        # becomes part of the new map, so must not be modified afterwards.
+        if not changes:
+            return self
+        top = changes
+        layers = self._layers
+        while layers and len(layers[0]) <= 2 * len(top):
+            merged = layers[0].copy()
+            merged.update(top)
+            top = merged
+            layers = layers[1:]
+        return RelocationMap((top,) + layers)
+
+    def remove(self, moved):
+        # Returns a new map without the names in this mapping from name to
+        # relocation, unless they have since been relocated somewhere else.
+        if not moved:
+            return self
+        merged = self._flatten()
+        for name, relto in moved.items():
+            if merged.get(name) == relto:
+                del merged[name]
+        if not merged:
+            return RelocationMap()
+        return RelocationMap((merged,))
+
+    def _flatten(self):
+        merged = {}
+        for layer in reversed(self._layers):
+            merged.update(layer)
+        return merged
+
+
 class MultiFlush:
     def __init__(self, directories, filesystem, reason):
         self.directories = directories
@@ -626,7 +1906,15 @@ class MultiFlush:
     def go(self):
         # First we get backlog token to ensure that there are not too many
         # of us in the work queue. This might stall whoever wanted to use us
+        stalled = self.filesystem._backlog_tokens.empty()
+        start = time.time()
         self.filesystem._backlog_tokens.get()
+        self.filesystem._flush_controller.queued(time.time() - start, stalled)
+        self.filesystem._flusher_cond.acquire()
+        try:
+            self.filesystem._batches_queued += 1
+        finally:
+            self.filesystem._flusher_cond.release()
         # Put ourself in the work queue
         self.filesystem._async_work_queue.put(self.flush)
 
@@ -636,22 +1924,304 @@ class MultiFlush:
             self.filesystem.ENGINE_NOISE,
             "Flushing %d transactions (%s)" % (len(self.directories), self.reason),
         )
-        dirmap = {}
+        if self.filesystem._journal_syncer is not None:
+            # With group commit, the renames of these transaction directories
+            # may not be durable yet. They must be before we move any of
+            # their files out of the journal.
+            self.filesystem._journal_syncer.sync_all()
+        if self.filesystem._relaxed_syncer is not None:
+            # Likewise with relaxed durability, for the whole transaction
+            self.filesystem._relaxed_syncer.sync_all()
         # Move many files from the journal directory to the database directory
-        for directory in self.directories:
-            self.filesystem._move_to_database_directory(directory, dirmap)
-            if self.filesystem._shutdown_flusher:
-                return
+        start = time.time()
+        files, written = self.filesystem._flush_transactions(self.directories)
+        if self.filesystem._shutdown_flusher:
+            return
         # we are done with these transaction directories, so can safely delete them
         for directory in self.directories:
             try:
-                self.filesystem.rmdir(directory)
+                if directory.endswith("_record"):
+                    self.filesystem.unlink(directory)
+                else:
+                    self.filesystem._remove_transaction_directory(directory)
             except EnvironmentError:
                 pass
         # Now we have completed flushing all of those, put an extra token
         # in the backlog queue. This possibly enabled another transaction to finish,
         # if there was a large backlog of finished but unflushed ones
+        self.filesystem._record_flush(files, written, time.time() - start)
+        self.filesystem._flush_controller.flushed()
         self.filesystem._backlog_tokens.put(0)
+        self.filesystem._notify_flusher_waiters(1)
+
+
+class JournalSyncer:
+    # Group commit. A transaction has committed once its directory has been
+    # renamed and the journal directory has been synced. Transactions are
+    # renamed one at a time under the storage commit lock, but the sync can
+    # be left until after that lock is released. One sync of the journal
+    # directory then makes the renames of every transaction which finished
+    # before it durable.
+    #
+    # Each rename takes a numbered ticket. A thread waiting for its ticket
+    # either waits for a sync in progress, or becomes the leader and performs
+    # the next sync itself on behalf of all tickets issued so far. The leader
+    # may first wait a short time so that more transactions can join.
+    #
+    # A transaction is published in the relocations mapping before it is
+    # durable, but nothing may be read from it until it is. Readers look up
+    # its ticket in _pending, and wait for it. _pending is replaced rather
+    # than modified, so that this lookup needs no lock.
+
+    def __init__(self, filesystem, max_wait):
+        self.filesystem = filesystem
+        self.max_wait = max_wait
+        self.syncs = 0
+        self._requested = 0
+        self._synced = 0
+        self._failed = 0
+        self._syncing = 0
+        # mapping from the path of a renamed transaction to its ticket,
+        # until it has been synced
+        self._pending = {}
+        self._cond = threading.Condition()
+
+    def request(self, path):
+        # Called after a rename, under the commit lock, before anything
+        # can find the transaction at its new path
+        self._cond.acquire()
+        try:
+            self._requested += 1
+            pending = self._pending.copy()
+            pending[path] = self._requested
+            self._pending = pending
+            return self._requested
+        finally:
+            self._cond.release()
+
+    def wait_for(self, path):
+        # Called before reading from the transaction at this path
+        ticket = self._pending.get(path)
+        if ticket is not None:
+            self.wait(ticket)
+
+    def sync_all(self):
+        # Make every rename so far durable
+        self._cond.acquire()
+        try:
+            ticket = self._requested
+        finally:
+            self._cond.release()
+        self.wait(ticket)
+
+    def wait(self, ticket):
+        self._cond.acquire()
+        try:
+            while self._synced < ticket:
+                if self._failed >= ticket:
+                    raise DirectoryStorageError("journal sync failed")
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                # Become the leader
+                self._syncing = 1
+                try:
+                    if self.max_wait:
+                        # Wait for other transactions to join. Nothing else
+                        # notifies while we are syncing, so this is a sleep
+                        # which releases the lock.
+                        self._cond.wait(self.max_wait)
+                    covered = self._requested
+                    self._cond.release()
+                    try:
+                        self.filesystem.sync_directory("journal")
+                    except:
+                        self._cond.acquire()
+                        self._failed = covered
+                        raise
+                    else:
+                        self._cond.acquire()
+                        self._synced = covered
+                        self.syncs += 1
+                        self._pending = dict(
+                            [(p, t) for p, t in self._pending.items() if t > covered]
+                        )
+                finally:
+                    self._syncing = 0
+                    self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def report(self):
+        return {"transactions": self._requested, "syncs": self.syncs}
+
+
+class FlushController:
+    # Adaptive flush thresholds. The configured flush_file_threshold and
+    # flush_transaction_threshold are the largest batch sizes. Large batches
+    # are efficient, but under heavy write pressure they pile up in the work
+    # queue. Once there are as many as [journal]/backlog, a commit stalls
+    # until the flusher has finished a whole batch. Smaller batches are
+    # finished sooner, so the stall is shorter.
+    #
+    # As each batch is queued we look at how long the commit stalled for a
+    # backlog token, and how many earlier batches are still outstanding.
+    # The thresholds are halved when the stall was longer than max_stall,
+    # reduced when batches are queueing behind the one being flushed, and
+    # grown back towards the configured values while the flusher is idle.
+    # A max_stall of zero keeps the configured thresholds, but stalls are
+    # still measured.
+
+    min_scale = 1.0 / 64
+
+    def __init__(self, filesystem, max_stall):
+        self.filesystem = filesystem
+        self.max_stall = max_stall
+        self.scale = 1.0
+        self.outstanding = 0
+        self.batches = 0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.max_stall_seconds = 0.0
+        self.last_stall_seconds = 0.0
+        # protects outstanding
+        self._lock = threading.Lock()
+
+    def file_threshold(self):
+        return max(1, int(self.filesystem.flush_file_threshold * self.scale))
+
+    def transaction_threshold(self):
+        return max(1, int(self.filesystem.flush_transaction_threshold * self.scale))
+
+    def queued(self, stall, stalled):
+        # Called under the flush lock, once a batch has its backlog token
+        self._lock.acquire()
+        try:
+            depth = self.outstanding
+            self.outstanding += 1
+        finally:
+            self._lock.release()
+        self.batches += 1
+        self.last_stall_seconds = stall
+        if stalled:
+            self.stalls += 1
+        self.stall_seconds += stall
+        if stall > self.max_stall_seconds:
+            self.max_stall_seconds = stall
+        if not self.max_stall:
+            return
+        if stall > self.max_stall:
+            scale = self.scale * 0.5
+        elif depth > 1:
+            scale = self.scale * 0.75
+        elif depth == 0:
+            scale = self.scale * 1.25
+        else:
+            return
+        self.scale = min(1.0, max(self.min_scale, scale))
+
+    def flushed(self):
+        # Called from the flusher thread when a batch is finished
+        self._lock.acquire()
+        try:
+            self.outstanding -= 1
+        finally:
+            self._lock.release()
+
+    def report(self):
+        return {
+            "file_threshold": self.file_threshold(),
+            "transaction_threshold": self.transaction_threshold(),
+            "outstanding": self.outstanding,
+            "batches": self.batches,
+            "stalls": self.stalls,
+            "stall_seconds": self.stall_seconds,
+            "max_stall_seconds": self.max_stall_seconds,
+            "last_stall_seconds": self.last_stall_seconds,
+        }
+
+
+class RelaxedSyncer:
+    # Relaxed durability. Transactions commit by renaming them in the journal
+    # without syncing anything, and this thread syncs them in batches every
+    # interval seconds. A crash loses at most the transactions committed in
+    # the last interval, plus the time taken to sync one batch. Recovery
+    # finds a torn transaction using its manifest or record checksum.
+    #
+    # After each batch the highest transaction synced is written to
+    # misc/synced, so that recovery trusts those without checking them.
+    # This is also why the flusher calls sync_all before moving any files
+    # out of the journal.
+
+    def __init__(self, filesystem, interval):
+        self.filesystem = filesystem
+        self.interval = interval
+        self.batches = 0
+        self.transactions = 0
+        self._pending = []
+        # protects _pending
+        self._lock = threading.Lock()
+        # held while syncing a batch
+        self._sync_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="DirectoryStorage relaxed sync"
+        )
+        self._thread.setDaemon(1)
+        self._thread.start()
+
+    def add(self, transaction):
+        # Called after a rename, under the commit lock
+        self._lock.acquire()
+        try:
+            self._pending.append(transaction)
+        finally:
+            self._lock.release()
+
+    def sync_all(self):
+        # Sync every transaction added so far
+        self._sync_lock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                pending = self._pending
+                self._pending = []
+            finally:
+                self._lock.release()
+            if not pending:
+                return
+            try:
+                for transaction in pending:
+                    transaction.sync()
+                self.filesystem.sync_directory("journal")
+                self.filesystem._write_synced_mark(pending[-1].tid)
+            except:
+                # Try again next time
+                self._lock.acquire()
+                try:
+                    self._pending[:0] = pending
+                finally:
+                    self._lock.release()
+                raise
+            self.batches += 1
+            self.transactions += len(pending)
+        finally:
+            self._sync_lock.release()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sync_all()
+            except:
+                logger.critical("Relaxed journal sync failed", exc_info=1)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.sync_all()
+
+    def report(self):
+        return {"batches": self.batches, "transactions": self.transactions}
 
 
 class QuickExitFromRecombine(Exception):
@@ -660,3 +2230,23 @@ class QuickExitFromRecombine(Exception):
 
 class FileMissingFromJournalError(Exception):
     pass
+
+
+class TornRecordError(RecoveryError):
+    pass
+
+
+# The name of the manifest in a transaction directory committed with
+# relaxed durability. No database file name starts with a dot.
+MANIFEST = ".manifest"
+
+# Lists the files flushed into B in snapshot mode, one path per line, in
+# the order they were written. Recombination moves them into A from here.
+RECOMBINE_MANIFEST = os.path.join("misc", "recombine")
+
+# Snapshot clones, made by clone_snapshot, are kept in here
+SNAPSHOTS = os.path.join("misc", "snapshots")
+
+# The most files copied out of the journal by one flush thread before they
+# are synced and renamed into place. Each is held open until then.
+FLUSH_COPIES = 64
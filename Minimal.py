@@ -18,10 +18,10 @@ from .utils import (OMAGIC, DirectoryStorageError,
 
 
 class Minimal(BaseDirectoryStorage):
-    def _load_object_file(self, oid):
+    def _load_object_file(self, oid, serial=None):
         stroid = oid2str(oid)
         try:
-            data = self.filesystem.read_database_file("o" + stroid)
+            data = self.filesystem.read_database_file_view("o" + stroid)
         except FileDoesNotExist:
             raise POSException.POSKeyError(oid)
         return data, None
@@ -33,9 +33,22 @@ class Minimal(BaseDirectoryStorage):
         except POSException.POSKeyError:
             return None
         self._check_object_file(oid, serial2, data, self._md5_overwrite)
-        serial = data[64:72]
+        serial = bytes(data[64:72])
         return serial
 
+    def _begin(self, tid, u, d, e):
+        BaseDirectoryStorage._begin(self, tid, u, d, e)
+        self._transaction_directory.oids = {}
+
+    def _finish(self, tid, user, desc, ext):
+        td = self._transaction_directory
+        BaseDirectoryStorage._finish(self, tid, user, desc, ext)
+        # Our object files are overwritten in place, so any cached copy of
+        # an object written in this transaction is now stale. This must
+        # happen after the new files become visible to readers.
+        for oid in td.oids.keys():
+            self._object_cache.invalidate(oid)
+
     def store(self, oid, serial, data, version, transaction):
         if self._is_read_only:
             raise POSException.ReadOnlyError(
@@ -45,7 +58,7 @@ class Minimal(BaseDirectoryStorage):
             raise POSException.StorageTransactionError(self, transaction)
         if version:
             raise DirectoryStorageVersionError("Versions are not supported")
-        old_serial = self._get_current_serial(oid)
+        old_serial = self._get_stored_serial(oid)
         if old_serial is None:
             # no previous revision of this object
             old_serial = z64
@@ -63,6 +76,7 @@ class Minimal(BaseDirectoryStorage):
 
     def _write_object_file(self, oid, newserial, body):
         td = self._transaction_directory
+        td.oids[oid] = 1
         stroid = oid2str(oid)
         td.write("o" + stroid, body)
 
@@ -0,0 +1,154 @@
+# Copyright (c) 2002 Toby Dickenson and contributors
+#
+# This library is subject to the provisions of the
+# GNU Lesser General Public License version 2.1
+
+import threading
+from collections import OrderedDict
+
+
+class ObjectCache:
+    # An in-process cache of recently loaded object files, keyed on
+    # (oid, serial) pairs. The total size of cached file bodies is kept
+    # within a byte budget by discarding the least recently used entries.
+    #
+    # Full storages cache immutable revision files, so entries only become
+    # invalid when packing removes them. Minimal storages overwrite their
+    # object files in place, and use a serial of None to mean 'the current
+    # revision'.
+    #
+    # A reader which misses the cache reads the file, then puts it here.
+    # If an invalidation happened between those two steps then the file
+    # it read may already be stale. Readers therefore note the generation
+    # before reading, and put() ignores anything read in an older generation.
+    #
+    # Entries put here by the prefetcher are flagged until their first use,
+    # to count how many prefetches were worthwhile.
+
+    def __init__(self, budget):
+        self.budget = budget
+        # A single entry may not take more than this fraction of
+        # the cache. Caching one huge object would flush everything else.
+        self.max_entry = budget // 4
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetch_used = 0
+        self.prefetch_unused = 0
+        self._generation = 0
+        self._entries = OrderedDict()
+        # mapping from oid to a dictionary set of cached serials for
+        # that oid, used for invalidation
+        self._serials = {}
+        # dictionary set of keys which were prefetched, and not yet used
+        self._prefetched = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        return self.lookup(key)[0]
+
+    def lookup(self, key):
+        # Returns the cached data or None, and a flag which is true if
+        # this is the first use of a prefetched entry.
+        if not self.budget:
+            return None, 0
+        self._lock.acquire()
+        try:
+            data = self._entries.get(key)
+            prefetched = 0
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                if self._prefetched.pop(key, None):
+                    self.prefetch_used += 1
+                    prefetched = 1
+            return data, prefetched
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        # Unlike get, this does not count as a use of the entry
+        self._lock.acquire()
+        try:
+            return key in self._entries
+        finally:
+            self._lock.release()
+
+    def put(self, key, data, generation, prefetched=0):
+        size = len(data)
+        if size > self.max_entry:
+            return
+        self._lock.acquire()
+        try:
+            if generation != self._generation:
+                # Something has been invalidated since this was read.
+                # It may be stale.
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self._serials.setdefault(key[0], {})[key[1]] = 1
+            if prefetched:
+                self._prefetched[key] = 1
+            else:
+                self._prefetched.pop(key, None)
+            self.size += size
+            while self.size > self.budget:
+                (oid, serial), old = self._entries.popitem(last=False)
+                self._forget_serial(oid, serial)
+                if self._prefetched.pop((oid, serial), None):
+                    self.prefetch_unused += 1
+                self.size -= len(old)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, oid):
+        # Discard all cached revisions of this oid
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            for serial in list(self._serials.pop(oid, {}).keys()):
+                self.size -= len(self._entries.pop((oid, serial)))
+                self._prefetched.pop((oid, serial), None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            self._entries.clear()
+            self._serials.clear()
+            self._prefetched.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def _forget_serial(self, oid, serial):
+        serials = self._serials[oid]
+        del serials[serial]
+        if not serials:
+            del self._serials[oid]
+
+    def report(self):
+        return {
+            "budget": self.budget,
+            "size": self.size,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "prefetch_used": self.prefetch_used,
+            "prefetch_unused": self.prefetch_unused,
+        }
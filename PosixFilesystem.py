@@ -4,6 +4,8 @@
 # GNU Lesser General Public License version 2.1
 
 import errno
+import fcntl
+import mmap
 import os
 import stat
 import struct
@@ -21,9 +23,33 @@ from ZODB.DB import DB
 from ZODB.FileStorage import FileStorage
 
 from .LocalFilesystem import (FileDoesNotExist, LocalFilesystem,
-                              LocalFilesystemTransaction)
-from .utils import (ConfigParserError, DirectoryStorageError, logger,
-                    loglevel_BLATHER, oid2str, z64, z128)
+                              LocalFilesystemTransaction,
+                              LocalRecordTransaction)
+from .utils import (ConfigParserError, DirectoryStorageError, content_crc32,
+                    content_length, logger, loglevel_BLATHER, oid2str, z64,
+                    z128)
+
+
+# The Linux ioctl which makes one file share the data of another, on
+# filesystems such as btrfs and xfs. Other systems fail it with ENOTTY.
+_FICLONE = 0x40049409
+_no_reflink = (
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+)
+
+# The most buffers one writev call accepts. Linux fails a longer list
+# with EINVAL, and a transaction record has several per object.
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (ValueError, OSError):
+    _IOV_MAX = -1
+if _IOV_MAX <= 0:
+    # POSIX guarantees at least this many
+    _IOV_MAX = 16
 
 
 class PosixFilesystem(LocalFilesystem):
@@ -42,8 +68,35 @@ class PosixFilesystem(LocalFilesystem):
                 self._use_dirsync = 1
         else:
             self._use_dirsync = 0
+        try:
+            self._mmap_threshold = self.config.getint("posix", "mmap_threshold")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info(
+                "assuming config/settings should have [posix]/mmap_threshold=1048576"
+            )
+            self._mmap_threshold = 1048576
+        try:
+            self.max_open_fds = self.config.getint("posix", "max_open_fds")
+            self._use_fdatasync = self.config.getint("posix", "fdatasync")
+        except ConfigParserError:
+            # settings files from 1.1.21 or earlier do not have this
+            logger.info("assuming config/settings should have [posix]/max_open_fds=64")
+            self.max_open_fds = 64
+            self._use_fdatasync = 0
+        if self._use_fdatasync and self.use_sync:
+            logger.log(
+                self.ENGINE_NOISE,
+                "fdatasync used for files. Transactions are durable only "
+                "if the filesystem orders metadata updates.",
+            )
+
+        # Whether clone_file should try a reflink first
+        self._use_reflink = self.clone_method != "link"
 
     def transaction(self, tid):
+        if self.journal_format == "record":
+            return LocalRecordTransaction(self, tid)
         return PosixFilesystemTransaction(self, tid)
 
     def exists(self, name):
@@ -75,12 +128,36 @@ class PosixFilesystem(LocalFilesystem):
         f = os.open(fullname, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o640)
         # Should we worry about EINTR ?
         try:
-            os.write(f, content)
+            self._write_content(f, content)
             if self.use_sync:
-                fsync(f)
+                self._sync_file(f)
         finally:
             os.close(f)
 
+    def _write_content(self, f, content):
+        if type(content) is not list:
+            os.write(f, content)
+            return
+        # A list of buffers is written with writev, rather than joining
+        # them first, which would copy a large pickle. Each call takes at
+        # most _IOV_MAX of them. Short writes are unusual, but allowed.
+        buffers = content
+        while buffers:
+            n = os.writev(f, buffers[:_IOV_MAX])
+            i = 0
+            while i < len(buffers) and n >= len(buffers[i]):
+                n -= len(buffers[i])
+                i += 1
+            buffers = buffers[i:]
+            if n:
+                buffers[0] = memoryview(buffers[0])[n:]
+
+    def _sync_file(self, f):
+        if self._use_fdatasync:
+            os.fdatasync(f)
+        else:
+            fsync(f)
+
     def modify_file(self, filename, offset, content):
         fullname = os.path.join(self.dirname, filename)
         f = os.open(fullname, os.O_CREAT | os.O_RDWR, 0o640)
@@ -90,26 +167,109 @@ class PosixFilesystem(LocalFilesystem):
         finally:
             os.close(f)
 
-    def first_half_write_file(self, filename, content):
+    def first_half_write_file(self, filename, content, keep_open=0):
         fullname = os.path.join(self.dirname, filename)
         f = os.open(fullname, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o640)
-        os.write(f, content)
+        try:
+            self._write_content(f, content)
+        except:
+            os.close(f)
+            raise
+        if keep_open and self.use_sync:
+            # The transaction has room for another open file
+            return _HalfWrittenFile(fullname, f)
         os.close(f)
         # Waaah, in the general case we cant afford to keep the file open
-        return fullname
+        return _HalfWrittenFile(fullname, None)
 
-    def second_half_write_file(self, fullname):
+    def second_half_write_file(self, file):
+        f = file.fd
+        file.fd = None
         if self.use_sync:
-            f = os.open(fullname, os.O_RDONLY)
+            if f is None:
+                f = os.open(file.fullname, os.O_RDONLY)
             try:
-                fsync(f)
+                self._sync_file(f)
             finally:
                 os.close(f)
+        elif f is not None:
+            os.close(f)
 
-    def abort_half_write_file(self, f):
-        pass
+    def sync_file(self, filename):
+        if self.use_sync:
+            f = os.open(os.path.join(self.dirname, filename), os.O_RDONLY)
+            try:
+                self._sync_file(f)
+            finally:
+                os.close(f)
+
+    def abort_half_write_file(self, file):
+        f = file.fd
+        if f is not None:
+            file.fd = None
+            os.close(f)
 
     def read_file(self, filename):
+        f = self._open_for_read(filename)
+        try:
+            return self._read_all(f, os.fstat(f).st_size)
+        finally:
+            os.close(f)
+
+    def read_file_view(self, filename):
+        f = self._open_for_read(filename)
+        try:
+            size = os.fstat(f).st_size
+            if size < self._mmap_threshold or not size:
+                return self._read_all(f, size)
+            # Large files are mapped rather than read, so that slicing out
+            # the pickle is the only copy. The mapping stays valid after the
+            # file is closed, and after it is unlinked or replaced by rename.
+            # DirectoryStorage never truncates a database file in place.
+            return memoryview(mmap.mmap(f, size, access=mmap.ACCESS_READ))
+        finally:
+            os.close(f)
+
+    def file_size(self, filename):
+        try:
+            return os.stat(os.path.join(self.dirname, filename)).st_size
+        except EnvironmentError as e:
+            if e.errno == errno.ENOENT:
+                raise FileDoesNotExist(
+                    "DirectoryStorage file %r does not exist" % (filename,)
+                )
+            raise
+
+    def read_file_range(self, filename, offset, length):
+        f = self._open_for_read(filename)
+        try:
+            c = os.pread(f, length, offset)
+            while len(c) < length:
+                chunk = os.pread(f, length - len(c), offset + len(c))
+                if not chunk:
+                    raise DirectoryStorageError(
+                        "DirectoryStorage file %r is too short" % (filename,)
+                    )
+                c += chunk
+        finally:
+            os.close(f)
+        return c
+
+    def _read_all(self, f, size):
+        # The size from fstat lets one read fetch the whole file directly
+        # into a buffer of the right size, in the common case.
+        c = os.read(f, size)
+        if len(c) < size:
+            chunks = [c]
+            while 1:
+                chunk = os.read(f, 1024 * 16)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            c = b"".join(chunks)
+        return c
+
+    def _open_for_read(self, filename):
         full = os.path.join(self.dirname, filename)
         while 1:
             try:
@@ -125,18 +285,7 @@ class PosixFilesystem(LocalFilesystem):
                 else:
                     raise
             else:
-                break
-        try:
-            chunks = []
-            while 1:
-                chunk = os.read(f, 1024 * 16)
-                if not chunk:
-                    break
-                chunks.append(chunk)
-            c = b"".join(chunks)
-        finally:
-            os.close(f)
-        return c
+                return f
 
     def listdir(self, filename, skip_marks=1):
         # Python os.listdir is not scalable. What alternative should we use?
@@ -165,6 +314,91 @@ class PosixFilesystem(LocalFilesystem):
     def rmdir(self, a):
         os.rmdir(os.path.join(self.dirname, a))
 
+    def _prepare_journal(self, path):
+        journal = os.path.join(self.dirname, "journal")
+        new = journal + ".new"
+        old = journal + ".old"
+        if not os.path.lexists(journal) and os.path.islink(new):
+            # A crash interrupted moving the journal, after the empty
+            # directory was moved aside. Finish it.
+            os.rename(new, journal)
+            self.sync_directory(".")
+        if os.path.islink(journal) and os.path.isdir(old):
+            os.rmdir(old)
+        if os.path.lexists(new):
+            # Or before the new link replaced the directory
+            os.unlink(new)
+        if path:
+            # Relative to the storage directory, if not absolute
+            path = os.path.join(self.dirname, path)
+            if os.path.islink(journal):
+                if os.path.realpath(journal) != os.path.realpath(path):
+                    raise DirectoryStorageError(
+                        "journal is a link to %r, not [journal]/path %r"
+                        % (os.readlink(journal), path)
+                    )
+            else:
+                # Move the journal there. This is only safe if there are no
+                # transactions in it. Empty slots can be recreated.
+                for file in os.listdir(journal):
+                    if not self._slot_re.match(file):
+                        raise DirectoryStorageError(
+                            "Can not move journal to %r; it is not empty" % (path,)
+                        )
+                    os.rmdir(os.path.join(journal, file))
+                if not os.path.isdir(path):
+                    os.mkdir(path, 0o750)
+                elif os.listdir(path):
+                    raise DirectoryStorageError(
+                        "[journal]/path %r is not empty" % (path,)
+                    )
+                # A directory can not be renamed over, so the empty one
+                # is moved aside first. The link is made under another
+                # name, so that journal is never missing or half made
+                # unless the new link is ready to be renamed into place.
+                os.symlink(path, new)
+                self.sync_directory(".")
+                os.rename(journal, old)
+                os.rename(new, journal)
+                self.sync_directory(".")
+                os.rmdir(old)
+                logger.info("Moved journal to %r" % (path,))
+        # The journal may also have been linked elsewhere by hand
+        return os.stat(journal).st_dev != os.stat(os.path.join(self.dirname, "A")).st_dev
+
+    def clone_file(self, a, b):
+        a = os.path.join(self.dirname, a)
+        b = os.path.join(self.dirname, b)
+        if self._use_reflink:
+            try:
+                self._reflink(a, b)
+                return
+            except EnvironmentError as e:
+                if self.clone_method == "reflink" or e.errno not in _no_reflink:
+                    raise
+                # This filesystem does not support them. Use hard links from
+                # now on.
+                logger.info("reflink not supported (%s), using hard links" % (e,))
+                self._use_reflink = 0
+        os.link(a, b)
+
+    def _reflink(self, a, b):
+        src = os.open(a, os.O_RDONLY)
+        try:
+            dst = os.open(b, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o640)
+            try:
+                fcntl.ioctl(dst, _FICLONE, src)
+            except:
+                os.close(dst)
+                os.unlink(b)
+                raise
+            os.close(dst)
+        finally:
+            os.close(src)
+
+    def modification_time(self, a):
+        return os.stat(os.path.join(self.dirname, a)).st_mtime
+
     _lock_file = None
     _sub_lock_file = None
 
@@ -199,7 +433,38 @@ class PosixFilesystem(LocalFilesystem):
 
 
 class PosixFilesystemTransaction(LocalFilesystemTransaction):
-    pass
+    # Descriptors of up to [posix]/max_open_fds files are kept open between
+    # writing each file and syncing it in finish, saving an open and close
+    # of each. Files in larger transactions are reopened, as before.
+
+    def __init__(self, filesystem, tid):
+        LocalFilesystemTransaction.__init__(self, filesystem, tid)
+        self.open_fds = 0
+
+    def write(self, name, data):
+        old = self.names.get(name, None)
+        if old is not None:
+            if old[1].fd is not None:
+                self.open_fds -= 1
+            self.filesystem.abort_half_write_file(old[1])
+        keep_open = self.open_fds < self.filesystem.max_open_fds
+        file = self.filesystem.first_half_write_file(
+            os.path.join(self.temp_name, name), data, keep_open
+        )
+        if file.fd is not None:
+            self.open_fds += 1
+        pair = len(self.names), file
+        self.names[name] = pair
+        if self.manifest is not None:
+            self.manifest[name] = content_length(data), content_crc32(data)
+
+
+class _HalfWrittenFile:
+    # Returned by first_half_write_file. fd is the open descriptor, or
+    # None if the file was closed after writing.
+    def __init__(self, fullname, fd):
+        self.fullname = fullname
+        self.fd = fd
 
 
 # various _XxxxxMarker classes implement different
@@ -0,0 +1,101 @@
+# Copyright (c) 2002 Toby Dickenson and contributors
+#
+# This library is subject to the provisions of the
+# GNU Lesser General Public License version 2.1
+
+import queue
+import threading
+
+from ZODB import POSException
+
+from .utils import ZODB_referencesf, logger
+
+
+class Prefetcher:
+    # Background read-ahead of objects which are likely to be loaded soon.
+    # When a client loads an object it will usually go on to load the
+    # objects it references, so once a loaded pickle has been handed back
+    # the references are read from it in a seperate thread, and those objects
+    # are read into the storage's object cache.
+    #
+    # Work is held on a bounded queue. If the queue is full then new work is
+    # dropped rather than making the loading thread wait; prefetching is only
+    # an optimisation. Each queue entry is an object file and its depth, the
+    # number of references followed from the object a client loaded. Objects
+    # at the depth limit are read into the cache, but their own references
+    # are not followed. A client using a prefetched object starts a new
+    # chain of read-ahead from there.
+
+    def __init__(self, storage, queue_size, depth):
+        self.storage = storage
+        self.depth = depth
+        self.queued = 0
+        self.dropped = 0
+        self.fetched = 0
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name="DirectoryStorage prefetch")
+        self._thread.setDaemon(1)
+        self._thread.start()
+
+    def loaded(self, data, depth=0):
+        # Called after an object file is loaded, either by a client or by
+        # the prefetcher itself.
+        if depth >= self.depth:
+            return
+        try:
+            self._queue.put_nowait((data, depth))
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.queued += 1
+
+    def close(self):
+        # Stop the thread after it has finished its current item. Anything
+        # still on the queue is discarded.
+        while 1:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while 1:
+            work = self._queue.get()
+            if work is None:
+                return
+            data, depth = work
+            try:
+                self._prefetch_references(data, depth)
+            except:
+                # A problem here will be seen again, and reported properly,
+                # if a client loads the object.
+                logger.debug("Prefetch failed", exc_info=1)
+
+    def _prefetch_references(self, data, depth):
+        pickle = bytes(data[72:])
+        if not pickle:
+            # George Bailey object
+            return
+        untransform = self.storage._db_untransform
+        if untransform:
+            pickle = untransform(pickle)
+        refoids = []
+        ZODB_referencesf(pickle, refoids)
+        for oid in refoids:
+            try:
+                data = self.storage._prefetch_object_file(oid)
+            except POSException.POSKeyError:
+                # a dangling reference
+                continue
+            if data is not None:
+                self.fetched += 1
+                self.loaded(data, depth + 1)
+
+    def report(self):
+        return {
+            "queued": self.queued,
+            "dropped": self.dropped,
+            "fetched": self.fetched,
+        }
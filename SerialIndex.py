@@ -0,0 +1,165 @@
+# Copyright (c) 2002 Toby Dickenson and contributors
+#
+# This library is subject to the provisions of the
+# GNU Lesser General Public License version 2.1
+
+import threading
+from array import array
+
+
+class SerialIndex:
+    # A memory-resident mapping from oid to current serial, used to avoid
+    # reading the current revision pointer file. A dict of 8-byte strings
+    # costs a couple of hundred bytes per object, so this is an open
+    # addressing hash table over two arrays of unsigned 64 bit integers.
+    # Each slot costs 16 bytes. A zero serial marks an empty slot; no real
+    # transaction has that serial.
+    #
+    # Entries are added in two ways. Transaction commit calls set() with
+    # the serial it has just written, or discard() if readers may not see
+    # that serial yet. A reader which missed calls fill() with the serial it
+    # read from the pointer file, but that may have been read before a
+    # concurrent commit. fill() therefore never replaces an existing entry,
+    # and is ignored if anything has been set, discarded or cleared since
+    # the reader noted the generation before reading.
+
+    def __init__(self, limit):
+        # Maximum number of entries. The whole index is discarded if
+        # this is exceeded. Zero disables the index.
+        self.limit = limit
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._reset(1024)
+
+    def _reset(self, capacity):
+        self._keys = array("Q", bytes(8 * capacity))
+        self._values = array("Q", bytes(8 * capacity))
+        self._shift = 64 - capacity.bit_length() + 1
+        self._mask = capacity - 1
+        self._used = 0
+
+    def __len__(self):
+        return self._used
+
+    def nbytes(self):
+        return (len(self._keys) + len(self._values)) * self._keys.itemsize
+
+    def generation(self):
+        return self._generation
+
+    def _home(self, key):
+        # Fibonacci hashing spreads the mostly-sequential oids evenly
+        return ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> self._shift
+
+    def _slot(self, key):
+        # Linear probing from its home slot finds the key or an empty slot
+        i = self._home(key)
+        keys, values, mask = self._keys, self._values, self._mask
+        while values[i] and keys[i] != key:
+            i = (i + 1) & mask
+        return i
+
+    def get(self, oid):
+        if not self.limit:
+            return None
+        key = int.from_bytes(oid, "big")
+        self._lock.acquire()
+        try:
+            value = self._values[self._slot(key)]
+        finally:
+            self._lock.release()
+        if value:
+            return value.to_bytes(8, "big")
+        return None
+
+    def set(self, oid, serial):
+        if not self.limit:
+            return
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            self._store(int.from_bytes(oid, "big"), int.from_bytes(serial, "big"), 1)
+        finally:
+            self._lock.release()
+
+    def fill(self, oid, serial, generation):
+        if not self.limit:
+            return
+        self._lock.acquire()
+        try:
+            if generation == self._generation:
+                self._store(
+                    int.from_bytes(oid, "big"), int.from_bytes(serial, "big"), 0
+                )
+        finally:
+            self._lock.release()
+
+    def discard(self, oid):
+        # Forget any entry for this oid
+        if not self.limit:
+            return
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            i = self._slot(int.from_bytes(oid, "big"))
+            keys, values, mask = self._keys, self._values, self._mask
+            if not values[i]:
+                return
+            # Shift later entries of the same run back into the hole, so
+            # every key stays reachable from its home slot without
+            # needing a marker for deleted slots. An entry may only move
+            # if its home slot is not between the hole and where it is.
+            j = i
+            while 1:
+                j = (j + 1) & mask
+                if not values[j]:
+                    break
+                home = self._home(keys[j])
+                if i <= j:
+                    stay = i < home <= j
+                else:
+                    stay = home > i or home <= j
+                if not stay:
+                    keys[i] = keys[j]
+                    values[i] = values[j]
+                    i = j
+            keys[i] = 0
+            values[i] = 0
+            self._used -= 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            self._reset(1024)
+        finally:
+            self._lock.release()
+
+    def _store(self, key, value, replace):
+        i = self._slot(key)
+        if self._values[i]:
+            if replace:
+                self._values[i] = value
+            return
+        if self._used >= self.limit:
+            # Too big. Start again rather than grow without bound;
+            # the working set will soon be read back in.
+            self._reset(1024)
+            i = self._slot(key)
+        self._keys[i] = key
+        self._values[i] = value
+        self._used += 1
+        if self._used * 2 > len(self._keys):
+            self._grow()
+
+    def _grow(self):
+        keys, values = self._keys, self._values
+        self._reset(len(keys) * 2)
+        for i in range(len(keys)):
+            if values[i]:
+                j = self._slot(keys[i])
+                self._keys[j] = keys[i]
+                self._values[j] = values[i]
+                self._used += 1
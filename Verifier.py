@@ -0,0 +1,66 @@
+# Copyright (c) 2002 Toby Dickenson and contributors
+#
+# This library is subject to the provisions of the
+# GNU Lesser General Public License version 2.1
+
+import queue
+import threading
+
+from .utils import DirectoryStorageError, logger, oid2str
+
+
+class Verifier:
+    # Background checksum verification of loaded object files, used when
+    # [md5policy]/read is 2. Loads check the checksum of a sample of files
+    # themselves, and pass the rest here so that the client does not wait
+    # for it. Corruption found here can not be reported to the client which
+    # loaded the file, so it is logged and counted instead, and the file
+    # is removed from the object cache.
+    #
+    # Work is held on a bounded queue. Files are left unverified rather than
+    # making loads wait when the queue is full.
+
+    def __init__(self, storage, queue_size):
+        self.storage = storage
+        self.verified = 0
+        self.dropped = 0
+        self.failures = 0
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name="DirectoryStorage verify")
+        self._thread.setDaemon(1)
+        self._thread.start()
+
+    def verify(self, oid, serial, data):
+        try:
+            self._queue.put_nowait((oid, serial, data))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # Finish verifying anything already queued, then stop the thread
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while 1:
+            work = self._queue.get()
+            if work is None:
+                return
+            oid, serial, data = work
+            try:
+                self.storage._check_object_file(oid, serial, data, 1)
+            except DirectoryStorageError as e:
+                self.failures += 1
+                logger.critical(
+                    "Background verification failed for oid %s: %s" % (oid2str(oid), e)
+                )
+                self.storage._object_cache.invalidate(oid)
+            else:
+                self.verified += 1
+
+    def report(self):
+        return {
+            "verified": self.verified,
+            "dropped": self.dropped,
+            "failures": self.failures,
+        }
@@ -33,7 +33,8 @@ from ZODB.DB import DB
 from ZODB.FileStorage import FileStorage
 
 from .LocalFilesystem import (FileDoesNotExist, LocalFilesystem,
-                              LocalFilesystemTransaction)
+                              LocalFilesystemTransaction,
+                              LocalRecordTransaction)
 from .utils import DirectoryStorageError, loglevel_BLATHER, oid2str, z64, z128
 
 
@@ -45,6 +46,8 @@ class WindowsFilesystem(LocalFilesystem):
         self.use_sync = 0
 
     def transaction(self, tid):
+        if self.journal_format == "record":
+            return LocalRecordTransaction(self, tid)
         return WindowsFilesystemTransaction(self, tid)
 
     def exists(self, name):
@@ -105,6 +108,8 @@ class WindowsFilesystem(LocalFilesystem):
 
     def write_file(self, filename, content):
         fullname = os.path.join(self.dirname, filename)
+        if type(content) is list:
+            content = b"".join(content)
         self._write_file(fullname, content)
 
     def modify_file(self, filename, offset, content):
@@ -116,8 +121,10 @@ class WindowsFilesystem(LocalFilesystem):
         finally:
             os.close(f)
 
-    def first_half_write_file(self, filename, content):
+    def first_half_write_file(self, filename, content, keep_open=0):
         fullname = os.path.join(self.dirname, filename)
+        if type(content) is list:
+            content = b"".join(content)
         self._write_file(fullname, content)
         return fullname
 
@@ -129,6 +136,14 @@ class WindowsFilesystem(LocalFilesystem):
             finally:
                 os.close(f)
 
+    def sync_file(self, filename):
+        if self.use_sync:
+            f = os.open(os.path.join(self.dirname, filename), os.O_RDONLY)
+            try:
+                fsync(f)
+            finally:
+                os.close(f)
+
     def abort_half_write_file(self, f):
         pass
 
@@ -217,6 +232,13 @@ class WindowsFilesystem(LocalFilesystem):
             # print "EEEK - directory not empty - nuking!"
             shutil.rmtree(os.path.join(self.dirname, a))
 
+    def clone_file(self, a, b):
+        # NTFS has hard links, but no reflinks
+        os.link(os.path.join(self.dirname, a), os.path.join(self.dirname, b))
+
+    def modification_time(self, a):
+        return os.stat(os.path.join(self.dirname, a)).st_mtime
+
     _lock_file = None
     _sub_lock_file = None
 
@@ -0,0 +1,396 @@
+#!/usr/bin/python2.1
+#
+# Copyright (c) 2002 Toby Dickenson and contributors
+#
+# This library is subject to the provisions of the
+# GNU Lesser General Public License version 2.1
+
+
+import getopt
+import io
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import ZODB
+except ImportError:
+    print(
+        "Failure to import ZODB is often caused by an incorrect PYTHONPATH environment variable",
+        file=sys.stderr,
+    )
+    raise
+
+try:
+    from ZODB.Connection import TransactionMetaData
+except ImportError:
+    # older ZODB
+    from transaction._transaction import Transaction as TransactionMetaData
+
+from .Filesystem import Filesystem
+from .mkds import mkds
+from .utils import ConfigParser, z64
+
+
+def usage():
+    return """Usage: %s [options] test
+
+A tool to measure the performance of DirectoryStorage. Each test
+creates a scratch storage in a temporary directory, and removes it
+afterwards.
+
+tests:
+
+  reads     - Load throughput of concurrent reader threads, for each
+              number of threads given by -t. The object cache is
+              disabled so that every load reads files.
+
+  sizes     - Load throughput of a single thread, for each pickle size
+              given by -z. The object cache is disabled.
+
+  writes    - Commit throughput of concurrent writer threads, for each
+              number of threads given by -t. Each transaction writes
+              -o new objects.
+
+  import    - Throughput of a bulk insert of -n new objects, in
+              transactions of -o objects each, and the time spent in
+              each store. Run with and without skipping the pointer
+              file lookup for freshly allocated oids.
+
+  allocation - Peak memory allocated while storing and committing one
+              object, for each pickle size given by -z. Reported as a
+              multiple of the pickle size.
+
+options:
+
+ -c section/option=value
+
+    Override a setting in the scratch storage's config/settings.
+    May be given more than once.
+
+ -d directory
+
+    Create the scratch storage inside this directory, rather than the
+    default temporary directory. Use this to measure a specific filesystem.
+
+ -f format
+
+    The storage format; bushy (the default) or chunky
+
+ -n count
+
+    Number of objects to create. Default 2000
+
+ -s bytes
+
+    Size of each object pickle. Default 100
+
+ -o count
+
+    Number of objects written in each transaction by the writes and
+    import tests. Default 10
+
+ -t threads
+
+    Comma separated list of reader thread counts. Default 1,2,4,8
+
+ -z sizes
+
+    Comma separated list of pickle sizes for the sizes test.
+    Default 100,10000,100000,1000000,4000000
+
+ -l seconds
+
+    How long to spend on each measurement. Default 5
+
+ -j
+
+    Leave the objects in the journal, rather than flushing them into
+    the database directory before measuring reads.
+
+ -h
+
+    Show this help
+""" % os.path.basename(
+        sys.argv[0]
+    )
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:d:f:n:s:o:t:z:l:j", [])
+    except getopt.GetoptError:
+        sys.exit(usage())
+    if len(args) != 1:
+        sys.exit(usage())
+    b = benchmark()
+    for o, a in opts:
+        if o == "-c":
+            option, value = a.split("=", 1)
+            section, option = option.split("/", 1)
+            b.settings[section, option] = value
+        elif o == "-d":
+            b.parent = a
+        elif o == "-f":
+            b.format = a
+        elif o == "-n":
+            b.count = int(a)
+        elif o == "-s":
+            b.size = int(a)
+        elif o == "-o":
+            b.per_transaction = int(a)
+        elif o == "-t":
+            b.threads = [int(t) for t in a.split(",")]
+        elif o == "-z":
+            b.sizes = [int(z) for z in a.split(",")]
+        elif o == "-l":
+            b.duration = float(a)
+        elif o == "-j":
+            b.journal = 1
+        else:
+            sys.exit(usage())
+    test = getattr(b, "test_" + args[0], None)
+    if test is None:
+        sys.exit(usage())
+    test()
+
+
+class benchmark:
+    def __init__(self):
+        self.parent = None
+        self.format = "bushy"
+        self.count = 2000
+        self.size = 100
+        self.threads = [1, 2, 4, 8]
+        self.sizes = [100, 10000, 100000, 1000000, 4000000]
+        self.duration = 5.0
+        self.journal = 0
+        self.per_transaction = 10
+        self.settings = {}
+
+    def test_reads(self):
+        storage = self.create("Full", {("cache", "size"): "0"})
+        try:
+            oids = self.populate(storage, self.count, self.size)
+            if not self.journal:
+                self.flush(storage)
+            print("%d objects of %d bytes" % (len(oids), self.size))
+            for nthreads in self.threads:
+                loads = self.measure_reads(storage, oids, nthreads)
+                print(
+                    "%3d threads: %9.0f loads/s"
+                    % (nthreads, loads / self.duration)
+                )
+        finally:
+            self.destroy(storage)
+
+    def test_sizes(self):
+        for size in self.sizes:
+            storage = self.create("Full", {("cache", "size"): "0"})
+            try:
+                # Enough objects to not be dominated by one file, without
+                # writing too much data
+                count = max(10, min(self.count, 100000000 // size))
+                oids = self.populate(storage, count, size)
+                self.flush(storage)
+                loads = self.measure_reads(storage, oids, 1)
+                rate = loads / self.duration
+                print(
+                    "%9d bytes: %9.0f loads/s %9.1f MB/s"
+                    % (size, rate, rate * size / 1000000.0)
+                )
+            finally:
+                self.destroy(storage)
+
+    def test_writes(self):
+        for nthreads in self.threads:
+            storage = self.create("Full")
+            try:
+                transactions = self.measure_writes(storage, nthreads)
+                print(
+                    "%3d threads: %9.1f transactions/s"
+                    % (nthreads, transactions / self.duration)
+                )
+            finally:
+                self.destroy(storage)
+
+    def test_import(self):
+        # Once as normal, then again with every store looking for the
+        # pointer file of its new object, as before fresh oids were
+        # recognised. Only the time spent in store is affected; the
+        # commits are timed too, for scale.
+        for skip in (1, 0):
+            storage = self.create("Full")
+            try:
+                if not skip:
+                    storage._get_stored_serial = storage._get_current_serial
+                data = record(self.size)
+                stored = 0
+                storing = 0.0
+                start = time.time()
+                while stored < self.count:
+                    t = TransactionMetaData()
+                    storage.tpc_begin(t)
+                    n = min(self.per_transaction, self.count - stored)
+                    begin = time.time()
+                    for i in range(n):
+                        storage.store(storage.new_oid(), z64, data, "", t)
+                    storing += time.time() - begin
+                    stored += n
+                    storage.tpc_vote(t)
+                    storage.tpc_finish(t)
+                elapsed = time.time() - start
+                print(
+                    "%s: %9.0f objects/s, %6.1f us in each store, "
+                    "%d pointer lookups skipped"
+                    % (
+                        skip and "   skipping" or "not skipping",
+                        self.count / elapsed,
+                        1000000 * storing / self.count,
+                        storage.get_cache_stats()["fresh_oid_skips"],
+                    )
+                )
+            finally:
+                self.destroy(storage)
+
+    def test_allocation(self):
+        storage = self.create("Full")
+        try:
+            # warm up, so that one-time allocations are not counted
+            self.populate(storage, 1, 100)
+            for size in self.sizes:
+                data = record(size)
+                tracemalloc.start()
+                try:
+                    before = tracemalloc.get_traced_memory()[0]
+                    t = TransactionMetaData()
+                    storage.tpc_begin(t)
+                    storage.store(storage.new_oid(), z64, data, "", t)
+                    storage.tpc_vote(t)
+                    storage.tpc_finish(t)
+                    peak = tracemalloc.get_traced_memory()[1] - before
+                finally:
+                    tracemalloc.stop()
+                print(
+                    "%9d bytes: %12d bytes peak %6.2f x pickle"
+                    % (size, peak, float(peak) / len(data))
+                )
+        finally:
+            self.destroy(storage)
+
+    def measure_writes(self, storage, nthreads):
+        # Run this many threads committing transactions for the configured
+        # duration, and return the total number of transactions.
+        counts = []
+        start = threading.Event()
+        deadline = []
+
+        def writer():
+            n = 0
+            start.wait()
+            end = deadline[0]
+            while time.time() < end:
+                self.populate(storage, self.per_transaction, self.size)
+                n += 1
+            counts.append(n)
+
+        threads = [threading.Thread(target=writer) for i in range(nthreads)]
+        for thread in threads:
+            thread.start()
+        deadline.append(time.time() + self.duration)
+        start.set()
+        for thread in threads:
+            thread.join()
+        return sum(counts)
+
+    def measure_reads(self, storage, oids, nthreads):
+        # Run this many threads loading random objects for the configured
+        # duration, and return the total number of loads.
+        counts = []
+        start = threading.Event()
+        deadline = []
+
+        def reader():
+            r = random.Random()
+            n = 0
+            start.wait()
+            end = deadline[0]
+            while time.time() < end:
+                for i in range(100):
+                    storage.load(r.choice(oids), "")
+                n += 100
+            counts.append(n)
+
+        threads = [threading.Thread(target=reader) for i in range(nthreads)]
+        for thread in threads:
+            thread.start()
+        deadline.append(time.time() + self.duration)
+        start.set()
+        for thread in threads:
+            thread.join()
+        return sum(counts)
+
+    def create(self, classname, settings={}):
+        # Create a new storage in a scratch directory. settings is a mapping
+        # from (section, option) to values overriding the default config,
+        # and is overridden by any settings given on the command line.
+        self.directory = tempfile.mkdtemp(dir=self.parent)
+        path = os.path.join(self.directory, "storage")
+        mkds(path, classname, self.format)
+        settings = dict(settings)
+        settings.update(self.settings)
+        if settings:
+            config = ConfigParser()
+            config.read(path + "/config/settings")
+            for (section, option), value in settings.items():
+                if not config.has_section(section):
+                    config.add_section(section)
+                config.set(section, option, value)
+            config.write(open(path + "/config/settings", "w"))
+        if classname == "Full":
+            from .Full import Full as S
+        else:
+            from .Minimal import Minimal as S
+        return S(Filesystem(path), synchronous=1)
+
+    def flush(self, storage):
+        # Flush the journal, and wait until it is empty
+        storage.filesystem.wait_until_flushed()
+
+    def destroy(self, storage):
+        storage.close()
+        shutil.rmtree(self.directory)
+
+    def populate(self, storage, count, size, per_transaction=100):
+        # Store count new objects, and return their oids
+        data = record(size)
+        oids = []
+        while len(oids) < count:
+            t = TransactionMetaData()
+            storage.tpc_begin(t)
+            for i in range(min(per_transaction, count - len(oids))):
+                oid = storage.new_oid()
+                storage.store(oid, z64, data, "", t)
+                oids.append(oid)
+            storage.tpc_vote(t)
+            storage.tpc_finish(t)
+        return oids
+
+
+def record(size):
+    # A ZODB data record with a payload of roughly this size, and no references
+    f = io.BytesIO()
+    p = pickle.Pickler(f, 3)
+    p.dump((("persistent.mapping", "PersistentMapping"), None))
+    p.dump({"data": {"payload": b"x" * size}})
+    return f.getvalue()
+
+
+if __name__ == "__main__":
+    main()
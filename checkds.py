@@ -13,6 +13,7 @@ import sys
 import time
 import traceback
 
+from DirectoryStorage import checksums
 from DirectoryStorage.Filesystem import Filesystem
 from DirectoryStorage.formats import formats
 from DirectoryStorage.snapshot import snapshot
@@ -234,12 +235,24 @@ class FullChecker(BaseChecker):
         if l != len(data):
             self.problem("transaction files with an inconsistent length", name)
             return 1
+        tag = data[16]
+        if tag not in checksums.names:
+            self.problem("transaction files with an unknown checksum algorithm", name)
+            return 1
+        if data[17:24] != z64[:7]:
+            self.problem(
+                "transaction files with non-zero bits in the reserved area", name
+            )
+            return 1
         md5sum = data[32:48]
         vdata = data[48:]
         if md5sum == z128:
             self.counter("transaction files with no checksum")
         else:
-            if hashlib.md5(vdata).digest() != md5sum:
+            self.counter(
+                "transaction files with %s checksum" % (checksums.names[tag],)
+            )
+            if checksums.checksum(tag, vdata) != md5sum:
                 self.problem("transaction files with a bad md5 checksum", name)
                 return 1
 
@@ -407,7 +420,7 @@ class FullChecker(BaseChecker):
     def check_object_file(self, oid, serial, data, name):
         # Given the body of an object file, check as much as we can. Its
         # redundant oid, its redundant serial number (if known), its
-        # redundant length, and md5 checksum of the whole file
+        # redundant length, and checksum of the whole file
         if OMAGIC != data[:4]:
             self.problem("object data files with a bad magic number", name)
             return 1
@@ -425,7 +438,12 @@ class FullChecker(BaseChecker):
         if otherserial >= serial:
             self.problem("object data files with a backwards undo pointer", name)
             return 1
-        if data[24:40] != z128:
+        # byte 24 is the checksum algorithm tag, the rest is reserved
+        tag = data[24]
+        if tag not in checksums.names:
+            self.problem("object data files with an unknown checksum algorithm", name)
+            return 1
+        if data[25:40] != z128[:15]:
             self.problem(
                 "object data files with non-zero bits in the reserved area", name
             )
@@ -435,7 +453,10 @@ class FullChecker(BaseChecker):
         if md5sum == z128:
             self.counter("object data files with no md5 checksum")
         else:
-            if hashlib.md5(serials_plus_pickle).digest() != md5sum:
+            self.counter(
+                "object data files with %s checksum" % (checksums.names[tag],)
+            )
+            if checksums.checksum(tag, serials_plus_pickle) != md5sum:
                 self.problem("object data files with bad md5 checksum", name)
                 return 1
         appserial = serials_plus_pickle[8:16]
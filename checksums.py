@@ -0,0 +1,80 @@
+# Copyright (c) 2002 Toby Dickenson and contributors
+#
+# This library is subject to the provisions of the
+# GNU Lesser General Public License version 2.1
+
+# Checksum algorithms for object and transaction files. Each file has a
+# 16 byte checksum slot, and one header byte naming the algorithm that
+# filled it. That byte was always zero in files written by 1.1.21 or
+# earlier, so tag zero is md5. Shorter checksums are stored big-endian
+# at the start of the slot, padded with zeros. An all-zero slot still
+# means no checksum was written.
+
+import hashlib
+import struct
+import zlib
+
+from .utils import DirectoryStorageError
+
+z96 = b"\0" * 12
+
+
+class _zlib_checksum:
+    # The hashlib interface, for the zlib running checksums
+    def __init__(self, function):
+        self.function = function
+        self.value = function(b"")
+
+    def update(self, data):
+        self.value = self.function(data, self.value)
+
+    def digest(self):
+        return struct.pack("!I", self.value) + z96
+
+
+def _blake2b():
+    return hashlib.blake2b(digest_size=16)
+
+
+_algorithms = {
+    # name: (tag, constructor)
+    "md5": (0, hashlib.md5),
+    "blake2b": (1, _blake2b),
+    "crc32": (2, lambda: _zlib_checksum(zlib.crc32)),
+    "adler32": (3, lambda: _zlib_checksum(zlib.adler32)),
+}
+
+tags = {}
+names = {}
+_constructors = {}
+for name, (tag, constructor) in _algorithms.items():
+    tags[name] = tag
+    names[tag] = name
+    _constructors[tag] = constructor
+
+
+def new(tag):
+    # Return a new incremental checksum object, with update and digest
+    # methods like hashlib. digest always returns 16 bytes.
+    try:
+        constructor = _constructors[tag]
+    except KeyError:
+        raise DirectoryStorageError("Unknown checksum algorithm tag %d" % (tag,))
+    return constructor()
+
+
+def checksum(tag, data):
+    c = new(tag)
+    c.update(data)
+    return c.digest()
+
+
+def tag_for_name(name):
+    try:
+        return tags[name]
+    except KeyError:
+        raise DirectoryStorageError("Unknown checksum algorithm %r" % (name,))
+
+
+assert checksum(0, b"abc") == hashlib.md5(b"abc").digest()
+assert checksum(2, b"abc") == struct.pack("!I", zlib.crc32(b"abc")) + z96
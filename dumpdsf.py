@@ -15,10 +15,11 @@ import traceback
 
 from ZODB.TimeStamp import TimeStamp
 
+from . import checksums
 from .formats import _chunky_munge_filename as munge
 from .Full import _tid_filename
 from .utils import (CMAGIC, OMAGIC, TMAGIC, ZODB_referencesf, oid2str,
-                    timestamp2tid)
+                    timestamp2tid, z128)
 
 
 def main():
@@ -31,7 +32,7 @@ def main():
 
 def dump(filename):
     try:
-        d = open(filename, "r").read()
+        d = open(filename, "rb").read()
     except:
         print(
             traceback.format_exception_only(sys.exc_info()[0], sys.exc_info()[1])[
@@ -69,6 +70,7 @@ def dump_o(d):
     print("    filename %s" % (munge("o" + stroid + "." + strprevtid),))
     pickle = d[72:]
     print("  pickle %r" % (pickle[:70],))
+    print("  checksum %s" % (checksum_name(d[24], d[40:56]),))
     r = []
     ZODB_referencesf(pickle, r)
     if r:
@@ -97,6 +99,7 @@ def dump_t(d):
     print("transaction %s" % (strtid,))
     print("  timestamp %s" % (time.ctime(TimeStamp(tid).timeTime()),))
     print("  proper filename %s" % munge(_tid_filename(tid)))
+    print("  checksum %s" % (checksum_name(d[16], d[32:48]),))
     lenu, lend, lene, leno, lenv = struct.unpack("!HHHIH", d[48:60])
     print("  user %r" % d[60 : 60 + lenu])
     print("  description %r" % d[60 + lenu : 60 + lenu + lend])
@@ -114,6 +117,12 @@ def dump_t(d):
         )
 
 
+def checksum_name(tag, value):
+    if value == z128:
+        return "none"
+    return checksums.names.get(tag, "unknown algorithm %d" % (tag,))
+
+
 def usage():
     return """Usage: %s filename
 
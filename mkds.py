@@ -109,9 +109,19 @@ write: %(somemd5s)d
 
 # check md5 on every read. This incurs a performance penalty. You may
 # want to change this to '0' if your ZEO server is using alot of
-# processor time
+# processor time. Alternatively '2' checks a fraction of reads, given
+# by read_fraction, and checks the rest in a background thread. Corruption
+# found in the background is logged, since it is too late to stop the
+# load which read it.
 read: %(somemd5s)d
 
+# The fraction of reads checked before returning, if read is 2.
+read_fraction: 0.1
+
+# If read is 2, the maximum number of files waiting for the background
+# thread. Further files are not checked while the queue is full.
+verify_queue: 1000
+
 # check the md5 of the old revision of an object, before we store
 # a new revision. This is only really useful if are not checking
 # md5 on every read
@@ -130,6 +140,18 @@ history: %(somemd5s)d
 # check when packing
 pack: %(somemd5s)d
 
+[checksum]
+
+# The options in [md5policy] control when checksums are calculated and
+# checked. This chooses the algorithm used for newly written files:
+#   md5       The only algorithm in 1.1.21 and earlier.
+#   blake2b   A cryptographic hash, faster than md5 on 64 bit machines.
+#   crc32     Much faster, and good at detecting accidental corruption.
+#   adler32   Faster still, but weaker for small files.
+# Each file records which algorithm was used, so this may be changed
+# at any time. Files written earlier can still be checked.
+write: md5
+
 [journal]
 
 # IO overhead is reduced by dealing with journal flushing
@@ -149,6 +171,100 @@ flush_transaction_threshold: 200
 # journal overload.
 backlog: 3
 
+# The longest time, in seconds, that a commit should stall waiting
+# for the flusher when the backlog is full. The file and transaction
+# thresholds above are reduced while the flusher falls behind, so that
+# each batch finishes sooner, and grown back while it is idle. 0 always
+# uses the thresholds above.
+max_commit_stall: 1
+
+# If enabled, transactions which finish at about the same time share one
+# sync of the journal directory, performed after the commit lock has been
+# released. Each transaction still does not finish until it is durable,
+# and reading its objects waits until then. The files in a transaction
+# are still synced one by one; this shares only the directory sync.
+group_commit: 0
+
+# How many seconds a group commit waits for more transactions to join
+# it before syncing. Zero means only transactions that finish while
+# another sync is in progress share the next one.
+group_commit_wait: 0
+
+# How transactions are written to the journal. 'directory' writes one
+# file for each object, in a directory for each transaction. 'record'
+# writes each transaction as a single file, which needs fewer files to be
+# created and synced when committing. The flusher copies records into the
+# database directory.
+format: directory
+
+# How many threads sync the files of a transaction in the 'directory'
+# journal format. Devices which can service many requests at once,
+# such as NVMe drives and RAID arrays, complete concurrent syncs much
+# faster. 1 syncs them one at a time.
+fsync_threads: 1
+
+# 'full' durability means a transaction is on stable storage before
+# the commit returns. 'relaxed' commits without syncing anything, and
+# syncs transactions in the background every relaxed_sync_interval
+# seconds. A crash may lose the transactions committed in that time,
+# but never leaves a partly written transaction. Unlike [filesystem]/sync=0,
+# the loss is bounded. This suits session data and caches.
+durability: full
+relaxed_sync_interval: 1
+
+# How many empty directories to keep in the journal for use by new
+# transactions, in the 'directory' journal format. This saves creating
+# a directory for each transaction, and removing it once the transaction
+# has been flushed. 0 creates a new directory every time. A transaction
+# keeps its directory until it is flushed, so this needs to be larger
+# than flush_transaction_threshold for every transaction to find one.
+slots: 0
+
+# Where to keep the journal, if not in the storage directory. A small
+# fast device such as an NVMe drive or battery backed storage lowers the
+# time spent syncing each commit. The journal directory is replaced by
+# a link to this directory the next time the storage is opened, which
+# requires the journal to be empty. Relative paths are relative to the
+# storage directory. When this is on a different filesystem, the
+# flusher copies files into the database rather than renaming them.
+path:
+
+# How many threads move files from the journal into the database
+# directory. Files are shared between the threads by the directory they
+# are moved into. More threads help when the flusher falls behind a
+# heavy write load, on devices which can service many requests at once.
+flush_threads: 1
+
+[cache]
+
+# How many bytes of recently loaded object files are kept in memory.
+# A cache hit avoids reading both the current revision pointer and the
+# object file, and avoids repeating the md5 check. Entries are
+# discarded least-recently-used first. Set to zero to disable.
+size: 16777216
+
+# Full storages keep the current serial of recently used objects in
+# memory, to avoid reading the pointer file on every load and store.
+# This is the maximum number of objects in that index; it costs
+# roughly 32 bytes per object. Set to zero to disable.
+serial_index: 1000000
+
+[prefetch]
+
+# When a client loads an object it usually goes on to load the objects
+# which it references. If enabled, a background thread reads those
+# referenced objects into the cache ahead of time. This needs a non-zero
+# [cache]/size. The get_cache_stats extension method reports how many
+# prefetched files were used.
+enabled: 0
+
+# Maximum number of loaded objects waiting for their references to be
+# prefetched. Further work is dropped while the queue is full.
+queue_size: 1000
+
+# How many levels of references to follow from each loaded object.
+depth: 1
+
 [storage]
 
 # What type of storage lives here
@@ -161,6 +277,11 @@ classname: %(classname)s
 # zero for no timeout.
 history_timeout: 10
 
+# How many threads are used to read files concurrently when a client
+# loads many objects at once, using the loadMany extension method.
+# Set to 1 to read them one at a time.
+load_threads: 4
+
 # If zero, unreachable database files are deleted during packing.
 # This is appropriate if you are using a stable version of
 # DirectoryStorage, do not expect any problems, and really need
@@ -198,8 +319,10 @@ min_pack_time: 600
 # problems that are hard to distinguish from database corruption.
 # Having this enabled is particularly useful during development.
 # These potential problems are somewhat theoretical, therefore
-# it is reasonably safe to disable this for a significant
-# performance improvement in write-heavy applications.
+# it is reasonably safe to disable this for a performance
+# improvement in write-heavy applications. The checks only find the
+# size of each referenced object's current revision, and are spread
+# across the storage/load_threads threads.
 check_dangling_references: 1
 
 # A choice of policy on how much information is kept about
@@ -249,6 +372,24 @@ sync: %(sync)d
 # a quick shutdown. Recombination can take a very long time.
 quick_shutdown: 0
 
+# How many directories in the database directories are remembered as
+# existing, so that moving a file into one does not need to check it
+# first. The bushy format has deep directory chains, which were checked
+# again on every journal flush. Each entry costs roughly 150 bytes. 0
+# always checks.
+known_directories: 65536
+
+# How the clone_snapshot extension method copies files into its
+# point-in-time copy of the database. 'reflink' makes copies which
+# share data with the originals, on filesystems which support it such
+# as btrfs and xfs. 'link' makes hard links. 'auto' tries reflink and
+# falls back to hard links.
+clone_method: auto
+
+# Snapshot clones older than this many seconds are removed when the
+# next one is made. 0 keeps them until they are removed explicitly.
+clone_max_age: 86400
+
 [windows]
 mark: attributes
 
@@ -277,6 +418,26 @@ mark: permissions
 
 dirsync: 1
 
+# Files at least this many bytes long are mapped using mmap rather than
+# read. Loading an object still returns a copy of its pickle, but the
+# whole file is not read into memory first. Smaller files are read with
+# a single read call.
+
+mmap_threshold: 1048576
+
+# The most files a transaction keeps open between writing them to the
+# journal and syncing them, which saves reopening each file. Files in
+# larger transactions are reopened.
+
+max_open_fds: 64
+
+# Use fdatasync rather than fsync for files. This skips updating
+# metadata that is not needed to read the data back, such as the
+# modification time. Only enable this on filesystems which guarantee
+# that metadata updates are ordered, such as ext4 with data=ordered.
+
+fdatasync: 0
+
 
 
 # Controls whether certain classes should have their history retained
@@ -167,7 +167,13 @@ class replica_slave:
             print("Fetching increment....", file=sys.stderr)
         request = self.get_request()
         p = pipeline()
-        tarname = os.path.join(self.path, "misc", ".replica.incoming")
+        if self.fs.journal_separate:
+            # It could not be renamed into the journal, so download it there.
+            # Recovery removes it if we do not finish.
+            incoming = "journal/.replica.incoming"
+        else:
+            incoming = "misc/.replica.incoming"
+        tarname = os.path.join(self.path, incoming)
         tarfd = os.open(tarname, os.O_RDWR | os.O_CREAT, 0o640)
         p.set_output(tarfd)
 
@@ -195,10 +201,10 @@ class replica_slave:
         # sync stuff to make it all durable
         os.fsync(tarfd)
         os.close(tarfd)
-        self.fs.sync_directory("misc")
+        self.fs.sync_directory(os.path.dirname(incoming))
 
         # Atomically commit this replica increment
-        self.fs.rename("misc/.replica.incoming", "journal/replica.tar")
+        self.fs.rename(incoming, "journal/replica.tar")
         self.fs.sync_directory("journal")
 
     def get_request(self):
@@ -58,6 +58,7 @@ And more ... look at http://dirstorage.sourceforge.net
     entry_points={
         "console_scripts": [
             "dirstorage_backup = DirectoryStorage.backup:main",
+            "dirstorage_benchmark = DirectoryStorage.benchmark:main",
             "dirstorage_checkds = DirectoryStorage.checkds:main",
             "dirstorage_ds2fs = DirectoryStorage.ds2fs:main",
             "dirstorage_dumpdsf = DirectoryStorage.dumpdsf:main",
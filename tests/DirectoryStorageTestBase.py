@@ -1,7 +1,6 @@
 import os
 import shutil
 import sys
-import time
 
 from DirectoryStorage.mkds import mkds
 from ZODB.tests import StorageTestBase
@@ -35,8 +34,7 @@ class DirectoryStorageTestBase(StorageTestBase.StorageTestBase):
 
     def _inter_pack_pause(self):
         # for TransactionalUndoStorage
-        while self._storage.filesystem.snapshot_code:
-            time.sleep(0.01)
+        self._storage.filesystem.wait_until_recombined()
 
     def _make_readonly(self):
         self._storage._is_read_only = 1
@@ -0,0 +1 @@
+cX}w
\ No newline at end of file
@@ -1,3 +1,4 @@
+import os
 import sys
 import threading
 import time
@@ -5,14 +6,18 @@ import traceback
 import unittest
 
 import DirectoryStorage.Filesystem
+import DirectoryStorage.Full
 import DirectoryStorage.utils
 from ZODB import POSException
+from ZODB.Connection import TransactionMetaData
 from ZODB.tests import (BasicStorage, ConflictResolution, Corruption,
                         HistoryStorage, IteratorStorage, MTStorage,
                         PackableStorage, PersistentStorage, ReadOnlyStorage,
                         RecoveryStorage, RevisionStorage, Synchronization,
                         TransactionalUndoStorage,
                         TransactionalUndoVersionStorage, VersionStorage)
+from ZODB.tests.MinPO import MinPO
+from ZODB.tests.StorageTestBase import zodb_pickle, zodb_unpickle
 
 from .DirectoryStorageTestBase import *
 
@@ -37,6 +42,873 @@ class DirectoryStorageFullTests:
         oid = self._storage.new_oid()
         assert oid == "\0\0\0\0\0\0\0\3", repr(oid)
 
+    def checkObjectCache(self):
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid=oid)
+        self._storage.load(oid, "")
+        hits = self._storage.get_cache_stats()["hits"]
+        pickle, serial = self._storage.load(oid, "")
+        assert serial == revid
+        assert self._storage.get_cache_stats()["hits"] == hits + 1
+
+    def checkLoadMany(self):
+        oids = []
+        for i in range(5):
+            oid = self._storage.new_oid()
+            self._dostore(oid=oid, data=i)
+            oids.append(oid)
+        loaded = self._storage.loadMany(oids)
+        assert len(loaded) == len(oids)
+        for oid, (pickle, serial) in zip(oids, loaded):
+            assert (pickle, serial) == self._storage.load(oid, "")
+        oid = self._storage.new_oid()
+        self.assertRaises(
+            POSException.POSKeyError, self._storage.loadMany, oids + [oid]
+        )
+
+    def checkLoadLargeObject(self):
+        # Large enough to be read using mmap
+        data = MinPO(b"x" * 2000000)
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid=oid, data=data)
+        self._storage._object_cache.clear()
+        pickle, serial = self._storage.load(oid, "")
+        assert type(pickle) is bytes
+        assert serial == revid
+        assert zodb_unpickle(pickle) == data
+
+    def checkChecksumAlgorithms(self):
+        from DirectoryStorage import checksums
+
+        self._storage._md5_read = 1
+        for name, tag in checksums.tags.items():
+            self._storage._checksum_tag = tag
+            oid = self._storage.new_oid()
+            revid = self._dostore(oid=oid, data=MinPO(name))
+            self._storage._object_cache.clear()
+            data, serial = self._storage._load_object_file(oid)
+            assert data[24] == tag
+            assert self._storage.load(oid, "") == (zodb_pickle(MinPO(name)), revid)
+            name = DirectoryStorage.Full._tid_filename(revid)
+            tdata = self._storage.filesystem.read_database_file(name)
+            self._storage._check_transaction_file(revid, tdata, 1)
+
+    def checkBackgroundVerification(self):
+        from DirectoryStorage.Verifier import Verifier
+
+        oid = self._storage.new_oid()
+        self._dostore(oid=oid)
+        self._storage._object_cache.clear()
+        self._storage._md5_read_fraction = 0
+        self._storage._verifier = verifier = Verifier(self._storage, 10)
+        try:
+            self._storage.load(oid, "")
+        finally:
+            self._storage._verifier = None
+            verifier.close()
+        assert verifier.verified == 1
+        # A corrupt file is detected, but not by the load
+        data = self._storage._load_checked(oid)
+        bad = data[:-1] + bytes([data[-1] ^ 1])
+        verifier = Verifier(self._storage, 10)
+        verifier.verify(oid, None, bad)
+        verifier.close()
+        assert verifier.failures == 1
+        # Closing the storage stops its verifier, and forgets it
+        self._storage._verifier = Verifier(self._storage, 10)
+        self._storage.close()
+        assert self._storage._verifier is None
+        self.open()
+
+    def checkGroupCommit(self):
+        from DirectoryStorage.LocalFilesystem import JournalSyncer
+
+        fs = self._storage.filesystem
+        fs._journal_syncer = syncer = JournalSyncer(fs, 0.001)
+        try:
+
+            def writer():
+                for i in range(5):
+                    self._dostore()
+
+            threads = [threading.Thread(target=writer) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            fs._journal_syncer = None
+        assert syncer._requested == 20
+        assert syncer._synced == 20
+        assert syncer.syncs <= 20
+
+    def checkGroupCommitVisibility(self):
+        from DirectoryStorage.LocalFilesystem import JournalSyncer
+
+        class SlowSync:
+            # Hold every journal sync until released
+            def __init__(self, fs):
+                self.fs = fs
+                self.started = threading.Event()
+                self.release = threading.Event()
+
+            def sync_directory(self, name):
+                self.started.set()
+                self.release.wait()
+                self.fs.sync_directory(name)
+
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid=oid, data=MinPO(1))
+        self._storage._object_cache.clear()
+        fs = self._storage.filesystem
+        slow = SlowSync(fs)
+        fs._journal_syncer = JournalSyncer(slow, 0)
+        try:
+            commits = []
+            committer = threading.Thread(
+                target=lambda: commits.append(
+                    self._dostore(oid=oid, revid=revid, data=MinPO(2))
+                )
+            )
+            committer.start()
+            assert slow.started.wait(5)
+            # The transaction has been renamed, but not synced. A load
+            # can not see it until it is durable.
+            loads = []
+            loader = threading.Thread(
+                target=lambda: loads.append(self._storage.load(oid, ""))
+            )
+            loader.start()
+            loader.join(0.2)
+            assert not loads
+            assert not commits
+            slow.release.set()
+            committer.join()
+            loader.join()
+        finally:
+            slow.release.set()
+            fs._journal_syncer = None
+        pickle, serial = loads[0]
+        assert serial == commits[0]
+        assert zodb_unpickle(pickle) == MinPO(2)
+
+    def _flush_journal(self):
+        # Flush the journal, and wait until no transactions remain in it
+        fs = self._storage.filesystem
+        assert fs.wait_until_flushed(5), "journal was not flushed"
+        assert not [n for n in fs.listdir("journal") if n.startswith("working_")]
+
+    def checkRecordJournal(self):
+        fs = self._storage.filesystem
+        fs.journal_format = "record"
+        try:
+            oid = self._storage.new_oid()
+            revid = self._dostore(oid=oid, data=MinPO(1))
+            revid = self._dostore(oid=oid, revid=revid, data=MinPO(2))
+            records = [f for f in fs.listdir("journal") if f.endswith("_record")]
+            assert len(records) == 2
+            # read from the records, before they are flushed
+            self._storage._object_cache.clear()
+            pickle, serial = self._storage.load(oid, "")
+            assert serial == revid
+            assert zodb_unpickle(pickle) == MinPO(2)
+            self._flush_journal()
+            self._storage._object_cache.clear()
+            pickle, serial = self._storage.load(oid, "")
+            assert serial == revid
+            assert zodb_unpickle(pickle) == MinPO(2)
+        finally:
+            fs.journal_format = "directory"
+
+    def checkLargeRecord(self):
+        from DirectoryStorage.LocalFilesystem import RelaxedSyncer
+
+        fs = self._storage.filesystem
+        fs.journal_format = "record"
+        try:
+            # more buffers than one writev call accepts, written as they
+            # are committed and with relaxed durability
+            for relaxed in (0, 1):
+                if relaxed:
+                    fs._relaxed_syncer = RelaxedSyncer(fs, 1000)
+                oids = [self._storage.new_oid() for i in range(300)]
+                t = TransactionMetaData()
+                self._storage.tpc_begin(t)
+                for oid in oids:
+                    self._storage.store(
+                        oid, DirectoryStorage.utils.z64, zodb_pickle(MinPO(oid)), "", t
+                    )
+                self._storage.tpc_vote(t)
+                self._storage.tpc_finish(t)
+                self._storage._object_cache.clear()
+                for oid in oids:
+                    assert zodb_unpickle(self._storage.load(oid, "")[0]) == MinPO(oid)
+                self._flush_journal()
+                if relaxed:
+                    fs._relaxed_syncer.close()
+                    fs._relaxed_syncer = None
+        finally:
+            if fs._relaxed_syncer is not None:
+                fs._relaxed_syncer.close()
+                fs._relaxed_syncer = None
+            fs.journal_format = "directory"
+
+    def checkParallelFsync(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        fs = self._storage.filesystem
+        fs._fsync_pool = pool = ThreadPoolExecutor(4)
+        try:
+            commits = fs.fsync_report()["commits"]
+            oids = [self._storage.new_oid() for i in range(10)]
+            t = TransactionMetaData()
+            self._storage.tpc_begin(t)
+            for oid in oids:
+                self._storage.store(
+                    oid, DirectoryStorage.utils.z64, zodb_pickle(MinPO(1)), "", t
+                )
+            self._storage.tpc_vote(t)
+            self._storage.tpc_finish(t)
+        finally:
+            fs._fsync_pool = None
+            pool.shutdown()
+        assert fs.fsync_report()["commits"] == commits + 1
+        for oid in oids:
+            assert zodb_unpickle(self._storage.load(oid, "")[0]) == MinPO(1)
+
+    def checkKeepOpenFiles(self):
+        fs = self._storage.filesystem
+        if not hasattr(fs, "max_open_fds"):
+            return
+        fs.max_open_fds = 2
+        try:
+            t = TransactionMetaData()
+            self._storage.tpc_begin(t)
+            oids = [self._storage.new_oid() for i in range(4)]
+            z64 = DirectoryStorage.utils.z64
+            for oid in oids:
+                self._storage.store(oid, z64, zodb_pickle(MinPO(1)), "", t)
+            # store one object twice in the transaction
+            self._storage.store(oids[0], z64, zodb_pickle(MinPO(2)), "", t)
+            td = self._storage._transaction_directory
+            assert td.open_fds <= 2
+            self._storage.tpc_vote(t)
+            self._storage.tpc_finish(t)
+        finally:
+            fs.max_open_fds = 64
+        for f in td.names.values():
+            assert f[1].fd is None
+        assert zodb_unpickle(self._storage.load(oids[0], "")[0]) == MinPO(2)
+        assert zodb_unpickle(self._storage.load(oids[3], "")[0]) == MinPO(1)
+
+    def checkDanglingReferences(self):
+        from DirectoryStorage.utils import DanglingReferenceError
+
+        children = []
+        for i in range(5):
+            ref = MinPO(i)
+            ref._p_oid = self._storage.new_oid()
+            self._dostore(oid=ref._p_oid, data=ref)
+            children.append(ref)
+        # flush some of them out of the journal
+        self._storage.filesystem._flush_all("test")
+        self._dostore(data=MinPO(children))
+        missing = MinPO(None)
+        missing._p_oid = self._storage.new_oid()
+        self.assertRaises(
+            DanglingReferenceError, self._dostore, data=MinPO(children + [missing])
+        )
+
+    def checkDanglingReferenceToUndoneCreation(self):
+        from DirectoryStorage.utils import DanglingReferenceError, z64
+
+        ref = MinPO(1)
+        ref._p_oid = self._storage.new_oid()
+        revid = self._dostore(oid=ref._p_oid, data=ref)
+        self._dostore(data=MinPO([ref]))
+        # Undo its creation, as transactionalUndo does, by writing a
+        # revision with an empty pickle
+        t = TransactionMetaData()
+        self._storage.tpc_begin(t)
+        tid = self._storage.get_current_transaction()
+        body = self._storage._make_file_body(ref._p_oid, tid, revid, b"", undofrom=z64)
+        self._storage._write_object_file(ref._p_oid, tid, body)
+        self._storage.tpc_vote(t)
+        self._storage.tpc_finish(t)
+        self.assertRaises(POSException.POSKeyError, self._storage.load, ref._p_oid, "")
+        self.assertRaises(DanglingReferenceError, self._dostore, data=MinPO([ref]))
+
+    def checkFreshOidSkip(self):
+        skips = self._storage.get_cache_stats()["fresh_oid_skips"]
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid=oid, data=MinPO(1))
+        assert self._storage.get_cache_stats()["fresh_oid_skips"] == skips + 1
+        # once committed, the object is checked for conflicts as normal
+        self.assertRaises(
+            POSException.ConflictError, self._dostore, oid=oid, data=MinPO(2)
+        )
+        self._dostore(oid=oid, revid=revid, data=MinPO(3))
+        assert self._storage.get_cache_stats()["fresh_oid_skips"] == skips + 1
+
+    def checkRelaxedDurability(self):
+        from DirectoryStorage.LocalFilesystem import (MANIFEST, RelaxedSyncer,
+                                                      _parse_manifest)
+
+        fs = self._storage.filesystem
+        fs._relaxed_syncer = syncer = RelaxedSyncer(fs, 1000)
+        try:
+            oid = self._storage.new_oid()
+            revid = self._dostore(oid=oid, data=MinPO(1))
+            lazy = [f for f in fs.listdir("journal") if f.endswith("_lazy")]
+            assert len(lazy) == 1
+            assert fs._lazy_transaction_is_complete(lazy[0])
+            manifest = fs.read_file("journal/" + lazy[0] + "/" + MANIFEST)
+            assert _parse_manifest(manifest) is not None
+            assert _parse_manifest(manifest[:-3]) is None
+            self._storage._object_cache.clear()
+            assert self._storage.load(oid, "")[1] == revid
+            syncer.sync_all()
+            assert syncer.report()["transactions"] == 1
+            assert fs.read_file("misc/synced") == lazy[0][8:24].encode("ascii")
+            self._flush_journal()
+        finally:
+            fs._relaxed_syncer = None
+            syncer.close()
+        self._storage._object_cache.clear()
+        assert self._storage.load(oid, "")[1] == revid
+
+    def checkRecoveryDiscardsLazyFollowers(self):
+        from DirectoryStorage.LocalFilesystem import RelaxedSyncer
+
+        fs = self._storage.filesystem
+        kept = self._storage.new_oid()
+        self._dostore(oid=kept, data=MinPO(0))
+        self._flush_journal()
+        fs._relaxed_syncer = syncer = RelaxedSyncer(fs, 1000)
+        try:
+            first = self._storage.new_oid()
+            self._dostore(oid=first, data=MinPO(1))
+            second = self._storage.new_oid()
+            self._dostore(oid=second, data=MinPO(2))
+            lazy = sorted([f for f in fs.listdir("journal") if f.endswith("_lazy")])
+            assert len(lazy) == 2
+            # a crash can lose the rename of the first transaction out of
+            # its temporary directory or slot while the second survives.
+            # the second may depend on the first, so neither is replayed
+            for name in (lazy[0][:-4] + "temp", "slot_9"):
+                crashed = directory + "_crashed"
+                shutil.copytree(directory, crashed)
+                try:
+                    journal = os.path.join(crashed, "journal")
+                    os.rename(
+                        os.path.join(journal, lazy[0]), os.path.join(journal, name)
+                    )
+                    storage = self._storage.__class__(
+                        fs.__class__(crashed), synchronous=1
+                    )
+                    try:
+                        assert zodb_unpickle(storage.load(kept, "")[0]) == MinPO(0)
+                        self.assertRaises(
+                            POSException.POSKeyError, storage.load, first, ""
+                        )
+                        self.assertRaises(
+                            POSException.POSKeyError, storage.load, second, ""
+                        )
+                    finally:
+                        storage.close()
+                finally:
+                    shutil.rmtree(crashed)
+        finally:
+            fs._relaxed_syncer = None
+            syncer.close()
+
+    def checkJournalSlots(self):
+        fs = self._storage.filesystem
+        if fs.journal_slots:
+            # configured with its own pool
+            return
+        fs.journal_slots = 2
+        try:
+            oid = self._storage.new_oid()
+            revid = self._dostore(oid=oid, data=MinPO(1))
+            revid = self._dostore(oid=oid, revid=revid, data=MinPO(2))
+            # the flusher returns each slot before it reports the batch
+            # as flushed
+            self._flush_journal()
+            assert len(fs._free_slots) == 2
+            slots = [n for n in fs.listdir("journal") if n.startswith("slot_")]
+            assert len(slots) == 2
+            # transactions reuse them
+            revid = self._dostore(oid=oid, revid=revid, data=MinPO(3))
+            assert len(fs._free_slots) == 1
+            self._storage._object_cache.clear()
+            pickle, serial = self._storage.load(oid, "")
+            assert serial == revid
+            assert zodb_unpickle(pickle) == MinPO(3)
+        finally:
+            fs.journal_slots = 0
+            fs._free_slots = []
+
+    def checkParallelFlush(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        fs = self._storage.filesystem
+        if fs._flush_pool is not None:
+            # configured with its own pool
+            return
+        fs.flush_threads = 4
+        fs._flush_pool = ThreadPoolExecutor(4)
+        try:
+            oids = []
+            revids = []
+            for i in range(20):
+                oid = self._storage.new_oid()
+                oids.append(oid)
+                revids.append(self._dostore(oid=oid, data=MinPO(i)))
+            # a second revision of some, in a later transaction
+            for i in range(0, 20, 3):
+                revids[i] = self._dostore(
+                    oid=oids[i], revid=revids[i], data=MinPO(i + 100)
+                )
+            self._flush_journal()
+            assert not fs.relocations
+            self._storage._object_cache.clear()
+            for i in range(20):
+                pickle, serial = self._storage.load(oids[i], "")
+                assert serial == revids[i]
+                if i % 3:
+                    assert zodb_unpickle(pickle) == MinPO(i)
+                else:
+                    assert zodb_unpickle(pickle) == MinPO(i + 100)
+        finally:
+            fs._flush_pool.shutdown()
+            fs._flush_pool = None
+            fs.flush_threads = 1
+
+    def checkFlushController(self):
+        from DirectoryStorage.LocalFilesystem import FlushController
+
+        fs = self._storage.filesystem
+        files = fs.flush_file_threshold
+        c = FlushController(fs, 0.5)
+        assert c.file_threshold() == files
+        # a long stall halves the thresholds
+        c.queued(1.0, 1)
+        assert c.file_threshold() == files // 2
+        # batches queueing behind the flusher shrink them further
+        c.queued(0.0, 0)
+        c.queued(0.0, 0)
+        assert c.file_threshold() < files // 2
+        # and they grow back once it has caught up
+        for i in range(3):
+            c.flushed()
+        for i in range(20):
+            c.queued(0.0, 0)
+            c.flushed()
+        assert c.file_threshold() == files
+        report = c.report()
+        assert report["batches"] == 23
+        assert report["stalls"] == 1
+        assert report["max_stall_seconds"] == 1.0
+        # the storage's own controller measures every batch
+        self._dostore()
+        fs._flush_all("test")
+        self._flush_journal()
+        assert fs.flush_report()["batches"] >= 1
+
+    def checkKnownDirectories(self):
+        fs = self._storage.filesystem
+        fs.known_directories = 1000
+        self._dostore()
+        fs._flush_all("test")
+        self._flush_journal()
+        known = list(fs._known_dirs)
+        assert known
+        hits = fs.known_dir_hits
+        # a neighbouring object is moved into the same directories
+        self._dostore()
+        fs._flush_all("test")
+        self._flush_journal()
+        assert fs.known_dir_hits > hits
+        assert fs.flush_report()["directory_stats_saved"] == fs.known_dir_hits
+        for directory in known:
+            fs.forget_directory(directory)
+            assert directory not in fs._known_dirs
+
+    def checkPackDuringFlush(self):
+        fs = self._storage.filesystem
+        fs.known_directories = 1000
+        oid = self._storage.new_oid()
+        self._dostore(oid=oid, data=MinPO(1))
+        self._flush_journal()
+        name = "o" + DirectoryStorage.utils.oid2str(oid) + ".c"
+        parent = os.path.split(os.path.join("A", fs.filename_munge(name)))[0]
+        assert parent in fs._known_dirs
+        # Packing removes the directory once it is empty. A flush which
+        # checked it just before then still remembers it
+        for file in fs.listdir(parent):
+            fs.unlink(os.path.join(parent, file))
+        self._storage._remove_unmarked_objects(0, None, parent)
+        assert not fs.exists(parent)
+        assert parent not in fs._known_dirs
+        fs._known_dirs[parent] = 1
+        # a neighbouring object is flushed into it
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid=oid, data=MinPO(2))
+        self._flush_journal()
+        name = "o" + DirectoryStorage.utils.oid2str(oid) + ".c"
+        assert os.path.split(os.path.join("A", fs.filename_munge(name)))[0] == parent
+        assert fs.exists(parent)
+        self._storage._object_cache.clear()
+        pickle, serial = self._storage.load(oid, "")
+        assert serial == revid
+        assert zodb_unpickle(pickle) == MinPO(2)
+
+    def checkRecombineManifest(self):
+        from DirectoryStorage.LocalFilesystem import RECOMBINE_MANIFEST
+
+        fs = self._storage.filesystem
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid=oid, data=MinPO(1))
+        fs.enter_snapshot("test")
+        try:
+            revid = self._dostore(oid=oid, revid=revid, data=MinPO(2))
+            self._flush_journal()
+            # the flushed files are listed
+            assert fs.read_file(RECOMBINE_MANIFEST).split()
+            assert fs.listdir("B")
+        finally:
+            fs.leave_snapshot("test")
+        assert fs.wait_until_recombined(5)
+        assert not fs.exists(RECOMBINE_MANIFEST)
+        assert not fs.listdir("B")
+        self._storage._object_cache.clear()
+        pickle, serial = self._storage.load(oid, "")
+        assert serial == revid
+        assert zodb_unpickle(pickle) == MinPO(2)
+
+    def checkRecombineTornManifest(self):
+        from DirectoryStorage.LocalFilesystem import RECOMBINE_MANIFEST
+
+        fs = self._storage.filesystem
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid=oid, data=MinPO(1))
+        fs.enter_snapshot("test")
+        try:
+            revid = self._dostore(oid=oid, revid=revid, data=MinPO(2))
+            self._flush_journal()
+            # a crash during an append leaves junk at the end, which the
+            # next append completes as a line
+            for junk in (b"\0\0\0\0", b"\xff\xfe", b"A/../x", b"/x"):
+                size = fs._recombine_manifest_size
+                fs.modify_file(RECOMBINE_MANIFEST, size, junk)
+                fs._recombine_manifest_size = size + len(junk)
+                revid = self._dostore(oid=oid, revid=revid, data=MinPO(3))
+                self._flush_journal()
+        finally:
+            fs.leave_snapshot("test")
+        assert fs.wait_until_recombined(5)
+        assert not fs.exists(RECOMBINE_MANIFEST)
+        assert not fs.listdir("B")
+        self._storage._object_cache.clear()
+        pickle, serial = self._storage.load(oid, "")
+        assert serial == revid
+        assert zodb_unpickle(pickle) == MinPO(3)
+
+    def _tree_contents(self, path):
+        fs = self._storage.filesystem
+        contents = {}
+        for file in fs.listdir(path):
+            p = os.path.join(path, file)
+            if fs.isdir(p):
+                for name, data in self._tree_contents(p).items():
+                    contents[os.path.join(file, name)] = data
+            else:
+                contents[file] = fs.read_file(p)
+        return contents
+
+    def checkSnapshotClone(self):
+        fs = self._storage.filesystem
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid=oid, data=MinPO(1))
+        self._flush_journal()
+        before = self._tree_contents("A")
+        # the clone is complete before another can be started
+        leave_snapshot = fs.leave_snapshot
+
+        def leave(code):
+            assert fs.exists(os.path.join("misc", "snapshots", "test"))
+            return leave_snapshot(code)
+
+        fs.leave_snapshot = leave
+        try:
+            path = self._storage.clone_snapshot("test")
+        finally:
+            del fs.leave_snapshot
+        try:
+            assert not fs.snapshot_code or fs.snapshot_code.startswith("recombining/")
+            assert self._tree_contents(path) == before
+            # later writes do not change the clone
+            self._dostore(oid=oid, revid=revid, data=MinPO(2))
+            self._flush_journal()
+            assert self._tree_contents("A") != before
+            assert self._tree_contents(path) == before
+        finally:
+            self._storage.remove_snapshot_clone("test")
+        assert not fs.exists(path)
+
+    def checkWaitUntilFlushed(self):
+        fs = self._storage.filesystem
+        self._dostore()
+        assert fs.wait_until_flushed(5)
+        assert not fs._unflushed
+        fs.enter_snapshot("test")
+        try:
+            assert not fs.wait_until_recombined(0.05)
+        finally:
+            fs.leave_snapshot("test")
+        assert fs.wait_until_recombined(5)
+        assert not fs.snapshot_code
+
+    def checkStats(self):
+        fs = self._storage.filesystem
+        self._flush_journal()
+        stats = self._storage.stats()
+        flushed = stats["flushed_files"]
+        elided = stats["elided_files"]
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid=oid, data=MinPO(1))
+        self._dostore(oid=oid, revid=revid, data=MinPO(2))
+        stats = self._storage.stats()
+        assert stats["unflushed_transactions"] == 2
+        assert stats["unflushed_files"] >= 2
+        assert stats["relocations"] >= 1
+        self._flush_journal()
+        stats = self._storage.stats()
+        assert stats["unflushed_transactions"] == 0
+        assert stats["relocations"] == 0
+        # the first revision of the object file was overwritten
+        assert stats["elided_files"] > elided
+        assert stats["flushed_files"] > flushed
+        assert stats["flushed_batches"] >= 1
+        assert "flush_stall_seconds" in stats
+
+    def checkSeparateJournal(self):
+        fs = self._storage.filesystem
+        if fs.journal_separate:
+            # configured with one
+            return
+        # Copy files out of the journal, as if it could not rename them
+        fs.journal_separate = 1
+        try:
+            oid = self._storage.new_oid()
+            revid = self._dostore(oid=oid, data=MinPO(1))
+            revid = self._dostore(oid=oid, revid=revid, data=MinPO(2))
+            # enough files to be synced and renamed in several groups
+            others = {}
+            for i in range(30):
+                other = self._storage.new_oid()
+                others[other] = self._dostore(oid=other, data=MinPO(i))
+            self._flush_journal()
+            self._storage._object_cache.clear()
+            pickle, serial = self._storage.load(oid, "")
+            assert serial == revid
+            assert zodb_unpickle(pickle) == MinPO(2)
+            for other, revid in others.items():
+                assert self._storage.load(other, "")[1] == revid
+        finally:
+            fs.journal_separate = 0
+
+    def checkSeparateJournalSyncOrder(self):
+        fs = self._storage.filesystem
+        if fs.journal_separate:
+            return
+        for format in ("directory", "record"):
+            fs.journal_format = format
+            for i in range(3):
+                self._dostore()
+            # the latest copy of each name is the one flushed. Earlier
+            # ones may be removed at any time
+            latest = {}
+            for transaction in sorted(fs.listdir("journal")):
+                if transaction.endswith("_done"):
+                    for file in fs.listdir("journal/" + transaction):
+                        latest[file] = "journal/%s/%s" % (transaction, file)
+            latest = dict([(path, 1) for path in latest.values()])
+            events = []
+
+            def recorder(name):
+                method = getattr(fs, name)
+
+                def record(*args):
+                    events.append((name,) + args)
+                    return method(*args)
+
+                return record
+
+            names = ("mkdir", "overwrite", "sync_directory", "unlink", "rmdir")
+            for name in names:
+                setattr(fs, name, recorder(name))
+            fs.journal_separate = 1
+            try:
+                self._flush_journal()
+            finally:
+                fs.journal_separate = 0
+                fs.journal_format = "directory"
+                for name in names:
+                    delattr(fs, name)
+            # every directory changed by the flush is synced before
+            # anything is removed from the journal
+            changed = {}
+            removed = 0
+            for event in events:
+                if event[0] == "mkdir":
+                    changed[os.path.split(event[1])[0]] = 1
+                elif event[0] == "overwrite":
+                    changed[os.path.split(event[1])[0]] = 1
+                    changed[os.path.split(event[2])[0]] = 1
+                elif event[0] == "sync_directory":
+                    changed.pop(event[1], None)
+                elif event[1] in latest or event[1].endswith("_record"):
+                    assert not changed, (event, changed)
+                    removed += 1
+                elif event[0] == "rmdir" and event[1].startswith("journal"):
+                    assert not changed, (event, changed)
+            assert removed
+
+    def checkMoveJournal(self):
+        if self._storage.filesystem.journal_path or not hasattr(os, "symlink"):
+            return
+        journal = os.path.join(directory, "journal")
+
+        def reopen():
+            fs = self.Filesystem(directory)
+            fs.journal_path = "moved"
+            self._storage = self._storage.__class__(fs, synchronous=1)
+            assert os.path.islink(journal)
+            moved = os.path.realpath(os.path.join(directory, "moved"))
+            assert os.path.realpath(journal) == moved
+            assert not os.path.lexists(journal + ".new")
+            assert not os.path.lexists(journal + ".old")
+
+        self._storage.close()
+        reopen()
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid=oid, data=MinPO(1))
+        # a crash can leave the link under its temporary name, with the
+        # empty directory moved aside
+        self._storage.filesystem.quick_shutdown = 1
+        self._storage.close()
+        os.rename(journal, journal + ".new")
+        os.mkdir(journal + ".old")
+        reopen()
+        # or leave a link which never replaced the directory
+        self._storage.close()
+        os.symlink("elsewhere", journal + ".new")
+        reopen()
+        pickle, serial = self._storage.load(oid, "")
+        assert serial == revid
+        assert zodb_unpickle(pickle) == MinPO(1)
+
+    def checkRelocationMap(self):
+        from DirectoryStorage.LocalFilesystem import RelocationMap
+
+        relocations = RelocationMap()
+        for i in range(1000):
+            old = relocations
+            relocations = relocations.add({"a": i, "b%d" % (i,): i})
+            # earlier maps are unchanged
+            assert old.get("b%d" % (i,)) is None
+        assert len(relocations._layers) <= 12
+        assert len(relocations) == 1001
+        assert relocations.get("a") == 999
+        assert relocations.get("b10") == 10
+        assert relocations.get("c") is None
+        # a name is only removed if it is still relocated to the same place
+        relocations = relocations.remove({"a": 998, "b10": 10})
+        assert relocations.get("a") == 999
+        assert relocations.get("b10") is None
+        assert len(relocations) == 1000
+
+    def checkPrefetch(self):
+        from DirectoryStorage.Prefetcher import Prefetcher
+
+        self._storage._prefetcher = Prefetcher(self._storage, 10, 1)
+        try:
+            child = self._storage.new_oid()
+            self._dostore(oid=child, data=MinPO(1))
+            ref = MinPO(None)
+            ref._p_oid = child
+            parent = self._storage.new_oid()
+            self._dostore(oid=parent, data=MinPO(ref))
+            self._storage._object_cache.clear()
+            self._storage.load(parent, "")
+            for i in range(100):
+                if self._storage._prefetcher.fetched:
+                    break
+                time.sleep(0.01)
+            used = self._storage.get_cache_stats()["prefetch_used"]
+            self._storage.load(child, "")
+            assert self._storage.get_cache_stats()["prefetch_used"] == used + 1
+        finally:
+            self._storage._prefetcher.close()
+            self._storage._prefetcher = None
+
+
+class DirectoryStorageMinimalTests:
+    def checkObjectCacheInvalidation(self):
+        # Minimal storages overwrite their object files in place, so a
+        # cached copy must be discarded when a transaction stores the
+        # object again, but not when that transaction is aborted.
+        oid = self._storage.new_oid()
+        revid = self._dostore(oid=oid, data=MinPO(1))
+        self._storage.load(oid, "")
+        assert (oid, None) in self._storage._object_cache
+        t = TransactionMetaData()
+        self._storage.tpc_begin(t)
+        self._storage.store(oid, revid, zodb_pickle(MinPO(2)), "", t)
+        self._storage.tpc_vote(t)
+        self._storage.tpc_abort(t)
+        pickle, serial = self._storage.load(oid, "")
+        assert serial == revid
+        assert zodb_unpickle(pickle) == MinPO(1)
+        revid = self._dostore(oid=oid, revid=revid, data=MinPO(3))
+        pickle, serial = self._storage.load(oid, "")
+        assert serial == revid
+        assert zodb_unpickle(pickle) == MinPO(3)
+        # and once the new revision has been flushed out of the journal
+        assert self._storage.filesystem.wait_until_flushed(5)
+        revid = self._dostore(oid=oid, revid=revid, data=MinPO(4))
+        assert self._storage.filesystem.wait_until_flushed(5)
+        pickle, serial = self._storage.load(oid, "")
+        assert serial == revid
+        assert zodb_unpickle(pickle) == MinPO(4)
+
+    def checkObjectFileBuffers(self):
+        from DirectoryStorage.utils import oid2str, z64
+
+        # The body of an object file is a list of buffers, and the pickle
+        # is one of them, not a copy
+        oid = self._storage.new_oid()
+        data = zodb_pickle(MinPO(b"x" * 100000))
+        body = self._storage._make_file_body(oid, z64, z64, data)
+        assert len(body) == 2
+        assert body[1] is data
+        # Files are written from such lists, in one call where possible
+        fs = self._storage.filesystem
+        fs.write_file("misc/.buffers", [b"abc", memoryview(b"defg")[1:], b""])
+        assert fs.read_file("misc/.buffers") == b"abcefg"
+        fs.unlink("misc/.buffers")
+        # and the object file written from them is intact, in the journal
+        # and once flushed
+        revid = self._dostore(oid=oid, data=MinPO(b"x" * 100000))
+        for i in range(2):
+            file = bytes(fs.read_database_file("o" + oid2str(oid)))
+            self._storage._check_object_file(oid, None, file, 1)
+            assert file[64:72] == revid
+            assert zodb_unpickle(file[72:]) == MinPO(b"x" * 100000)
+            assert fs.wait_until_flushed(5)
+
 
 class _PackableStorage(PackableStorage.PackableStorage):
 
@@ -120,7 +992,7 @@ class FullChunkyTest(FullChunkyBase, FullZODBTests, FullTests):
     pass
 
 
-class MinimalTests(BasicStorage.BasicStorage):
+class MinimalTests(BasicStorage.BasicStorage, DirectoryStorageMinimalTests):
     pass
 
 
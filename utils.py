@@ -7,6 +7,7 @@ import binascii
 import pickle
 import struct
 import time
+import zlib
 
 from ZODB import POSException
 from ZODB.TimeStamp import TimeStamp
@@ -84,6 +85,28 @@ TMAGIC = b"G@\x07v"
 # size
 CMAGIC = b"\013\376\350\354"
 
+# the first four bytes of transaction record files in the journal,
+# used by the 'record' journal format
+RMAGIC = b"R\x8e\x1dj"
+
+
+def content_length(content):
+    # The length of content to be written to a file, which is either
+    # bytes or a list of buffers
+    if type(content) is list:
+        return sum([len(b) for b in content])
+    return len(content)
+
+
+def content_crc32(content):
+    # The crc32 of content to be written to a file
+    if type(content) is list:
+        crc = 0
+        for b in content:
+            crc = zlib.crc32(b, crc)
+        return crc
+    return zlib.crc32(content)
+
 
 def oid2str(oid):
     assert len(oid) == 8